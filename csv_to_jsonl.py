@@ -1,12 +1,36 @@
 #!/usr/bin/env python3
 
 import argparse
+import codecs
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 import csv
+from datetime import date, datetime
+import gzip
+from itertools import chain
 import json
 import logging
 import os
+import re
 import reprlib
 import sys
+from time import monotonic as monotime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
 
 
 logger = logging.getLogger(__name__)
@@ -18,57 +42,501 @@ _repr_obj.maxother = 200
 smart_repr = _repr_obj.repr
 
 
+def stdlib_encode_json(obj):
+    return (json.dumps(obj, default=json_default, separators=(',', ':'), ensure_ascii=False) + '\n').encode()
+
+
+# pick the fastest available JSON encoder; encode_json returns bytes including newline,
+# all backends produce the same compact UTF-8 form as orjson
+if orjson is not None:
+    json_backend = 'orjson'
+    def encode_json(obj):
+        try:
+            return orjson.dumps(obj, default=json_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+        except orjson.JSONEncodeError:
+            # for example integers that do not fit into 64 bits
+            return stdlib_encode_json(obj)
+elif ujson is not None:
+    json_backend = 'ujson'
+    def encode_json(obj):
+        return (ujson.dumps(obj, default=json_default, escape_forward_slashes=False, ensure_ascii=False) + '\n').encode()
+elif simplejson is not None:
+    json_backend = 'simplejson'
+    def encode_json(obj):
+        return (simplejson.dumps(obj, default=json_default, separators=(',', ':'), ensure_ascii=False) + '\n').encode()
+else:
+    json_backend = 'json'
+    encode_json = stdlib_encode_json
+
 
 def main():
     p = argparse.ArgumentParser()
     p.add_argument('--verbose', '-v', action='store_true')
-    p.add_argument('--yaml', action='store_true')
+    g = p.add_mutually_exclusive_group()
+    g.add_argument('--yaml', action='store_true')
+    g.add_argument('--parquet', action='store_true', help='write Parquet (requires pyarrow)')
+    g.add_argument('--arrow', action='store_true', help='write Arrow IPC file, aka Feather v2 (requires pyarrow)')
+    p.add_argument('--output', '-o', metavar='FILE', help='output file (default: stdout)')
+    p.add_argument('--compress', choices=['gzip', 'zstd'],
+        help='compress JSONL/YAML output (default: by --output suffix .gz or .zst)')
+    p.add_argument('--row-group-size', type=int, default=65536, help='rows per Parquet row group or Arrow record batch')
+    p.add_argument('--jobs', '-j', type=int, default=1, help='convert in N worker processes')
+    p.add_argument('--infer-types', '-t', action='store_true', help='infer column types (int, float, bool, date, datetime) from a sample')
+    p.add_argument('--schema', metavar='FILE', help='JSON file with column types, skips type inference')
+    p.add_argument('--write-schema', metavar='FILE', help='write inferred column types to JSON file')
+    p.add_argument('--encoding', '-e', default='utf-8,cp1250',
+        help='comma-separated input encodings to try in order (default: %(default)s)')
     p.add_argument('csv_file', nargs='?')
     args = p.parse_args()
 
+    columnar_format = 'parquet' if args.parquet else 'arrow' if args.arrow else None
+    compression = args.compress
+    if not compression and args.output:
+        compression = {'.gz': 'gzip', '.zst': 'zstd'}.get(os.path.splitext(args.output)[1])
+    if columnar_format and args.jobs > 1:
+        p.error('--jobs is supported only for JSONL and YAML output')
+    if columnar_format and compression:
+        p.error('--compress is supported only for JSONL and YAML output')
+    for encoding in args.encoding.split(','):
+        try:
+            codecs.lookup(encoding)
+        except LookupError:
+            p.error('Unknown encoding: {}'.format(encoding))
+    # check optional modules before the output file is truncated
+    if columnar_format:
+        try:
+            import pyarrow
+        except ImportError:
+            sys.exit('Module pyarrow is not installed, {} output is not available'.format(columnar_format))
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            sys.exit('Module zstandard is not installed, zstd compression is not available')
+
     logging.basicConfig(
         format='%(levelname)5s: %(message)s',
         level=logging.DEBUG if args.verbose else logging.WARNING)
 
     if not args.csv_file or args.csv_file == '-':
-        csv_data = sys.stdin.buffer.read()
+        csv_stream = sys.stdin.buffer
     else:
-        csv_data = open(args.csv_file, 'rb').read()
+        csv_stream = open(args.csv_file, 'rb')
+
+    schema = None
+    if args.schema:
+        with open(args.schema) as f:
+            schema = json.load(f)
 
     try:
-        csv_to_jsonl(csv_data, yaml_output=args.yaml)
+        with open_output(args.output, compression) as output_stream:
+            csv_to_jsonl(csv_stream, yaml_output=args.yaml, jobs=args.jobs,
+                schema=schema, infer_types=args.infer_types or bool(args.write_schema),
+                write_schema=args.write_schema, encodings=args.encoding.split(','),
+                output_stream=output_stream, columnar_format=columnar_format,
+                row_group_size=args.row_group_size)
     except BrokenPipeError as e:
         os._exit(1)
 
 
-def csv_to_jsonl(csv_data, yaml_output):
-    assert isinstance(csv_data, bytes)
-    logger.debug('data: %s', smart_repr(csv_data))
-    text = decode(csv_data)
-    logger.debug('decoded: %s', smart_repr(text))
+sniff_size = 1024 * 1024
+read_size = 1024 * 1024
+chunk_size = 4 * 1024 * 1024
+write_batch_size = 1024 * 1024
 
-    dialect = csv.Sniffer().sniff(text[:100000])
-    logger.debug('Sniffed CSV dialect: %s', obj_attributes(dialect))
 
-    lines = text.splitlines(True)
-    reader = csv.DictReader(lines, dialect=dialect)
-    rows = list(reader)
-    logger.debug('Total CSV rows: %s', len(rows))
+def csv_to_jsonl(csv_stream, yaml_output, jobs=1, schema=None, infer_types=False, write_schema=None,
+                 encodings=('utf-8', 'cp1250'), output_stream=None, columnar_format=None, row_group_size=65536):
+    prefix = csv_stream.read(sniff_size)
+    assert isinstance(prefix, bytes)
+    logger.debug('data: %s', smart_repr(prefix))
 
-    for row in rows:
-        if '' in row and row[''] == None or row[''] == '':
-            row.pop('')
+    lines = iter_lines(prefix, csv_stream, FallbackDecoder(encodings))
+    head = []
+    head_size = 0
+    head_complete = True
+    for line in lines:
+        head.append(line)
+        head_size += len(line)
+        if head_size >= 100000:
+            head_complete = False
+            break
+    logger.debug('decoded: %s', smart_repr(''.join(head)))
 
-    if yaml_output:
-        import yaml
-        for row in rows:
-            if row.get('') == '':
-                del row['']
-            print(yaml.dump(dict(row), default_flow_style=False, width=250, allow_unicode=True).rstrip('\n'))
-            print('---')
+    dialect = csv.Sniffer().sniff(''.join(head)[:100000])
+    fmtparams = obj_attributes(dialect)
+    logger.debug('Sniffed CSV dialect: %s', fmtparams)
+
+    if schema is None and infer_types:
+        sample_rows = list(csv.DictReader(head, **fmtparams))
+        if not head_complete and len(sample_rows) > 1:
+            # the last row may be cut in the middle of a multi-line field
+            sample_rows.pop()
+        schema = infer_schema(sample_rows)
+        logger.debug('Inferred schema: %s', schema)
+        if write_schema:
+            with open(write_schema, 'w') as f:
+                json.dump(schema, f, indent=2)
+                f.write('\n')
+
+    if not yaml_output and not columnar_format:
+        logger.debug('JSON encoder: %s', json_backend)
+
+    if output_stream is None:
+        output_stream = sys.stdout.buffer
+    t0 = monotime()
+    lines = chain(head, lines)
+    if columnar_format:
+        reader = csv.DictReader(lines, **fmtparams)
+        rows = iter_rows(reader, compile_converters(schema))
+        row_count = write_columnar(rows, reader.fieldnames or [], schema, columnar_format, output_stream, row_group_size)
+    elif jobs > 1:
+        out = BatchWriter(output_stream)
+        fieldnames = next(csv.reader(lines, **fmtparams))
+        row_count = convert_parallel(lines, fieldnames, fmtparams, yaml_output, schema, jobs, out)
+        out.flush()
+    else:
+        out = BatchWriter(output_stream)
+        reader = csv.DictReader(lines, **fmtparams)
+        converters = compile_converters(schema)
+        row_count = 0
+        for row in iter_rows(reader, converters):
+            out.write(format_row(row, yaml_output))
+            row_count += 1
+        out.flush()
+    duration = monotime() - t0
+    logger.debug('Total CSV rows: %s in %.2f s (%.0f rows/s)', row_count, duration, row_count / max(duration, 1e-6))
+
+
+class BatchWriter:
+    '''
+    Collects output in a buffer and writes it to the stream in large blocks.
+    '''
+
+    def __init__(self, stream, batch_size=write_batch_size):
+        self.stream = stream
+        self.batch_size = batch_size
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+        if self.size >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.parts:
+            self.stream.write(b''.join(self.parts))
+            self.parts = []
+            self.size = 0
+        self.stream.flush()
+
+
+@contextmanager
+def open_output(path, compression=None):
+    '''
+    Open output file (or stdout) for binary writing, optionally compressed.
+    '''
+    f = open(path, 'wb') if path and path != '-' else sys.stdout.buffer
+    try:
+        if compression == 'gzip':
+            with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6) as zf:
+                yield zf
+        elif compression == 'zstd':
+            import zstandard
+            with zstandard.ZstdCompressor().stream_writer(f, closefd=False) as zf:
+                yield zf
+        else:
+            assert not compression
+            yield f
+    finally:
+        if f is not sys.stdout.buffer:
+            f.close()
+
+
+arrow_type_names = {
+    'int': 'int64',
+    'float': 'float64',
+    'bool': 'bool_',
+    'date': 'date32',
+    'datetime': 'timestamp',
+    'null': 'string',
+    'str': 'string',
+}
+
+arrow_value_checks = {
+    'int': lambda v: type(v) is int and -2**63 <= v < 2**63,
+    'float': lambda v: type(v) is float or type(v) is int,
+    'bool': lambda v: type(v) is bool,
+    'date': lambda v: type(v) is date,
+    'datetime': lambda v: type(v) is datetime,
+}
+
+
+def write_columnar(rows, fieldnames, schema, columnar_format, stream, row_group_size):
+    '''
+    Write rows as Parquet or Arrow IPC file, one row group (record batch) per row_group_size rows.
+    '''
+    import pyarrow
+
+    def arrow_type(name):
+        type_name = arrow_type_names[(schema or {}).get(name, 'str')]
+        return pyarrow.timestamp('us') if type_name == 'timestamp' else getattr(pyarrow, type_name)()
+
+    arrow_schema = pyarrow.schema([(name, arrow_type(name)) for name in fieldnames])
+    if columnar_format == 'parquet':
+        import pyarrow.parquet
+        writer = pyarrow.parquet.ParquetWriter(stream, arrow_schema)
+    elif columnar_format == 'arrow':
+        writer = pyarrow.ipc.new_file(stream, arrow_schema)
     else:
+        raise Exception('Unknown columnar format: {!r}'.format(columnar_format))
+
+    # values that do not match the column type (not covered by the sample the schema was
+    # inferred from) would make from_pylist fail in the middle of the file - write them as null
+    checks = [(name, arrow_value_checks[schema[name]]) for name in fieldnames if (schema or {}).get(name) in arrow_value_checks]
+    mismatch_counts = {}
+    row_count = 0
+    with writer:
+        batch = []
         for row in rows:
-            print(json.dumps(row))
+            for name, check in checks:
+                v = row.get(name)
+                if v is not None and not check(v):
+                    if name not in mismatch_counts:
+                        logger.warning('Column %r: value %r does not match type %s, written as null', name, v, schema[name])
+                    mismatch_counts[name] = mismatch_counts.get(name, 0) + 1
+                    row[name] = None
+            batch.append(row)
+            if len(batch) >= row_group_size:
+                writer.write_batch(pyarrow.RecordBatch.from_pylist(batch, schema=arrow_schema))
+                row_count += len(batch)
+                batch = []
+        if batch or not row_count:
+            writer.write_batch(pyarrow.RecordBatch.from_pylist(batch, schema=arrow_schema))
+            row_count += len(batch)
+    for name, count in mismatch_counts.items():
+        logger.warning('Column %r: %d values not matching type %s written as null', name, count, schema[name])
+    return row_count
+
+
+def convert_parallel(lines, fieldnames, fmtparams, yaml_output, schema, jobs, out):
+    '''
+    Convert chunks of lines in a process pool, write results in the input order.
+    '''
+    row_count = 0
+    pending = deque()
+    with ProcessPoolExecutor(jobs) as executor:
+        for chunk in iter_chunks(lines, fmtparams.get('quotechar'), chunk_size):
+            if len(pending) >= jobs * 2:
+                n, data = pending.popleft().result()
+                out.write(data)
+                row_count += n
+            pending.append(executor.submit(convert_chunk, chunk, fieldnames, fmtparams, yaml_output, schema))
+        while pending:
+            n, data = pending.popleft().result()
+            out.write(data)
+            row_count += n
+    return row_count
+
+
+def iter_chunks(lines, quotechar, size):
+    '''
+    Join lines into chunks of roughly given size, split only between CSV records.
+    '''
+    chunk = []
+    chunk_len = 0
+    in_quotes = False
+    for line in lines:
+        chunk.append(line)
+        chunk_len += len(line)
+        if quotechar and line.count(quotechar) % 2:
+            # newline inside quoted field - the record continues on the next line
+            in_quotes = not in_quotes
+        if chunk_len >= size and not in_quotes:
+            yield ''.join(chunk)
+            chunk = []
+            chunk_len = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def convert_chunk(chunk, fieldnames, fmtparams, yaml_output, schema):
+    reader = csv.DictReader(chunk.splitlines(True), fieldnames=fieldnames, **fmtparams)
+    converters = compile_converters(schema)
+    out = [format_row(row, yaml_output) for row in iter_rows(reader, converters)]
+    return len(out), b''.join(out)
+
+
+def format_row(row, yaml_output):
+    if yaml_output:
+        return format_yaml_row(row)
+    else:
+        return encode_json(row)
+
+
+_yaml_plain_re = re.compile(r'(?!\d)[\w][\w .\-/]*(?<! )\Z')
+
+# YAML 1.1 bool and null values that must not be written as plain strings
+_yaml_reserved = {'y', 'n', 'yes', 'no', 'on', 'off', 'true', 'false', 'null'}
+
+_yaml_key_cache = {}
+
+
+def format_yaml_row(row):
+    '''
+    Format flat dict as YAML document with sorted keys, followed by '---'.
+
+    Keys are rendered only once and typical scalars are formatted directly;
+    anything else falls back to the libyaml dumper (if available).
+    '''
+    lines = []
+    try:
+        for k, v in sorted(row.items()):
+            try:
+                yk = _yaml_key_cache[k]
+            except KeyError:
+                yk = _yaml_key_cache[k] = yaml_scalar(k) + ':'
+            lines.append(yk + ' ' + yaml_scalar(v))
+    except (TypeError, ValueError):
+        return yaml_dump_row(row)
+    lines.append('---\n')
+    return '\n'.join(lines).encode()
+
+
+def yaml_scalar(v):
+    if v is None:
+        return 'null'
+    if v is True:
+        return 'true'
+    if v is False:
+        return 'false'
+    t = type(v)
+    if t is str:
+        if _yaml_plain_re.match(v) and v.lower() not in _yaml_reserved:
+            return v
+        if v.replace('\n', '').replace('\t', '').isprintable():
+            # JSON string literal is a valid YAML double-quoted scalar
+            return json.dumps(v, ensure_ascii=False)
+    elif t is int:
+        return str(v)
+    elif t is float:
+        if v != v:
+            return '.nan'
+        if v in (float('inf'), float('-inf')):
+            return '.inf' if v > 0 else '-.inf'
+        r = repr(v)
+        if 'e' in r and '.' not in r:
+            # YAML 1.1 resolves 1e+20 as a string, 1.0e+20 as a float
+            r = r.replace('e', '.0e')
+        return r
+    elif t is datetime or t is date:
+        return v.isoformat()
+    raise ValueError('Unsupported value for YAML fast path: {!r}'.format(v))
+
+
+def yaml_dump_row(row):
+    import yaml
+    Dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+    return (yaml.dump(row, Dumper=Dumper, default_flow_style=False, width=250, allow_unicode=True).rstrip('\n') + '\n---\n').encode()
+
+
+def json_default(obj):
+    if isinstance(obj, (date, datetime)):
+        return obj.isoformat()
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+
+def iter_rows(reader, converters=()):
+    for row in reader:
+        if row.get('') in (None, ''):
+            row.pop('', None)
+        for key, convert in converters:
+            if key in row:
+                row[key] = convert(row[key])
+        yield row
+
+
+def parse_bool(s):
+    try:
+        return {'true': True, 'false': False}[s.lower()]
+    except KeyError:
+        raise ValueError('Not a bool: {!r}'.format(s))
+
+
+type_checks = [
+    ('int', re.compile(r'-?(0|[1-9][0-9]*)\Z').match),
+    ('float', re.compile(r'[-+]?((0|[1-9][0-9]*)(\.[0-9]*)?|\.[0-9]+)([eE][-+]?[0-9]+)?\Z').match),
+    ('bool', re.compile(r'(?i)(true|false)\Z').match),
+    ('date', re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2}\Z').match),
+    # date-only values are not datetimes - fromisoformat would add T00:00:00
+    ('datetime', re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2}[T ][0-9]{2}:[0-9]{2}(:[0-9]{2}(\.[0-9]+)?)?(Z|[+-][0-9]{2}:?[0-9]{2})?\Z').match),
+]
+
+type_parsers = {
+    'int': int,
+    'float': float,
+    'bool': parse_bool,
+    'date': date.fromisoformat,
+    'datetime': datetime.fromisoformat,
+    'null': lambda s: s,
+}
+
+
+def infer_schema(rows):
+    '''
+    Return dict column name -> type name (int, float, bool, date, datetime, null, str).
+    Columns of type other than str have empty values converted to null.
+    '''
+    values = {}
+    for row in rows:
+        for k, v in row.items():
+            if isinstance(k, str) and isinstance(v, str):
+                values.setdefault(k, set()).add(v)
+    schema = {}
+    for k, vs in values.items():
+        vs.discard('')
+        if not vs:
+            schema[k] = 'null'
+            continue
+        for type_name, check in type_checks:
+            if all(check(v) for v in vs):
+                schema[k] = type_name
+                break
+        else:
+            schema[k] = 'str'
+    return schema
+
+
+def compile_converters(schema):
+    '''
+    Return list of (column name, converter function) for columns that are not str.
+    '''
+    if not schema:
+        return []
+    converters = []
+    for key, type_name in schema.items():
+        if type_name == 'str':
+            continue
+        try:
+            parse = type_parsers[type_name]
+        except KeyError:
+            raise Exception('Unknown type {!r} of column {!r}'.format(type_name, key))
+        converters.append((key, _nullable(parse)))
+    return converters
+
+
+def _nullable(parse):
+    def convert(s):
+        if not s:
+            return None
+        try:
+            return parse(s)
+        except ValueError:
+            # value not matching the schema (the sample did not cover it) - keep as is
+            return s
+    return convert
 
 
 def obj_attributes(obj):
@@ -83,12 +551,66 @@ def obj_attributes(obj):
     return attrs
 
 
-def decode(data):
-    try:
-        return data.decode('utf-8')
-    except UnicodeDecodeError as e:
-        logger.info('Failed to decode as UTF-8: %s', smart_repr(e))
-    return data.decode('cp1250')
+class FallbackDecoder:
+    '''
+    Incremental decoder that tries the given encodings in order.
+
+    Input is decoded with the first encoding until an invalid byte is found;
+    from that byte on the rest of the input is decoded with the next encoding.
+    The last encoding replaces invalid bytes instead of failing.
+    '''
+
+    def __init__(self, encodings):
+        self.encodings = [codecs.lookup(enc).name for enc in encodings]
+        assert self.encodings
+        self.index = 0
+        self.decoder = self._new_decoder()
+
+    @property
+    def encoding(self):
+        return self.encodings[self.index]
+
+    def _new_decoder(self):
+        last = self.index == len(self.encodings) - 1
+        return codecs.getincrementaldecoder(self.encoding)(errors='replace' if last else 'strict')
+
+    def decode(self, data, final=False):
+        parts = []
+        while True:
+            try:
+                parts.append(self.decoder.decode(data, final=final))
+                return ''.join(parts)
+            except UnicodeDecodeError as e:
+                # e.object contains also the bytes buffered by the decoder from previous calls
+                parts.append(e.object[:e.start].decode(self.encoding))
+                data = e.object[e.start:]
+                self.index += 1
+                logger.info('Failed to decode as %s: %s; decoding the rest as %s',
+                    e.encoding, smart_repr(e), self.encoding)
+                if self.index == len(self.encodings) - 1:
+                    logger.debug('Invalid %s bytes will be replaced', self.encoding)
+                self.decoder = self._new_decoder()
+
+
+def iter_lines(prefix, stream, decoder):
+    '''
+    Decode the byte stream incrementally and yield lines including line endings.
+    '''
+    pending = ''
+    chunk = prefix
+    while True:
+        final = not chunk
+        text = pending + decoder.decode(chunk, final=final)
+        lines = text.splitlines(True)
+        if not final and lines and not lines[-1].endswith('\n'):
+            # incomplete line (or \r of a \r\n split between chunks)
+            pending = lines.pop()
+        else:
+            pending = ''
+        yield from lines
+        if final:
+            break
+        chunk = stream.read(read_size)
 
 
 if __name__ == '__main__':
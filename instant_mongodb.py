@@ -3,7 +3,12 @@
 '''
 This is just a thin wrapper around `mongod`.
 
-Parameters are set with respect to typical development settings (smallfiles, localhost).
+Parameters are set with respect to typical development settings (localhost).
+
+Useful for trying other tools from this repository, for example:
+
+    $ instant_mongodb.py --datadir /tmp/mongo-data &
+    $ mongo_overview.py --structure mongodb://127.0.0.1:7017/
 '''
 
 import argparse
@@ -24,13 +29,14 @@ def main():
     p.add_argument('--auth', '-a', action='store_true', help='run with security')
     p.add_argument('--wiredTiger', '-w', action='store_true')
     p.add_argument('--zlib', '-z', action='store_true', help='wiredTiger only: use zlib compression')
+    p.add_argument('--smallfiles', action='store_true', help='MMAPv1 only, for mongod older than 4.2')
     args = p.parse_args()
     signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     # ^^^ sys.exit() will raise SystemExit and all finally and catch blocks
     #     will be executed, terminating any running subprocesses
     p = mongodb_process(
         data_dir=args.datadir, port=int(args.port),
-        auth=args.auth, wiredtiger=args.wiredTiger, use_zlib=args.zlib)
+        auth=args.auth, wiredtiger=args.wiredTiger, use_zlib=args.zlib, smallfiles=args.smallfiles)
     try:
         p.wait()
     finally:
@@ -39,7 +45,7 @@ def main():
             p.wait()
 
 
-def mongodb_process(data_dir, port, auth, wiredtiger, use_zlib):
+def mongodb_process(data_dir, port, auth, wiredtiger, use_zlib, smallfiles=False):
     if not isdir(data_dir):
         os.mkdir(data_dir)
     cmd = [
@@ -47,8 +53,9 @@ def mongodb_process(data_dir, port, auth, wiredtiger, use_zlib):
         '--port', str(port),
         '--bind_ip', localhost,
         '--nounixsocket',
-        '--dbpath', data_dir,
-        '--smallfiles']
+        '--dbpath', data_dir]
+    if smallfiles:
+        cmd.append('--smallfiles')
     if auth:
         cmd.append('--auth')
     if wiredtiger:
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+'''
+Select and project JSONL records:
+
+    $ jsonl_filter.py --where status=error --where http.code=500 --fields ts,http.url app.jsonl
+
+Values in --where are parsed as JSON if possible (5, true, null, "007"),
+otherwise taken as strings. Multiple --where conditions must all match.
+
+Lines that certainly cannot match are skipped by a cheap substring check
+on the raw line before the JSON is parsed, so selective queries on large
+files are not slowed down by JSON decoding of all lines.
+
+The same filter stage (--where, --fields) is available in jsonl_sort_keys.py
+and jsonl_to_yaml.py.
+'''
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+logger = logging.getLogger(__name__)
+
+read_size = 4 * 1024 * 1024
+
+# orjson silently parses integers that do not fit into 64 bits as floats
+_long_number_re = re.compile(r'[0-9]{19}')
+_long_number_re_bytes = re.compile(rb'[0-9]{19}')
+
+
+def loads(line):
+    '''
+    Parse JSON line (str or bytes); lines with long numbers are parsed by stdlib json.
+    '''
+    if orjson is None:
+        return json.loads(line)
+    long_number_re = _long_number_re_bytes if isinstance(line, bytes) else _long_number_re
+    if long_number_re.search(line):
+        return json.loads(line)
+    return orjson.loads(line)
+
+
+# characters that every JSON encoder writes to strings as they are
+_plain_string_re = re.compile(r"[ !#-%'-.0-;=?-\[\]-~]*\Z")
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--verbose', '-v', action='store_true')
+    add_filter_arguments(p)
+    p.add_argument('input_file', nargs='?', help='JSONL file (default: stdin)')
+    args = p.parse_args()
+    logging.basicConfig(
+        format='%(levelname)5s: %(message)s',
+        level=logging.DEBUG if args.verbose else logging.WARNING)
+    try:
+        flt = filter_from_args(args)
+    except ValueError as e:
+        p.error(str(e))
+    input_stream = open(args.input_file, 'rb') if args.input_file else sys.stdin.buffer
+    try:
+        filter_stream(flt, input_stream, sys.stdout.buffer)
+        sys.stdout.flush()
+    except BrokenPipeError as e:
+        os._exit(1)
+
+
+def filter_stream(flt, input_stream, output_stream):
+    rest = b''
+    while True:
+        data = input_stream.read(read_size)
+        if not data:
+            lines = [rest]
+        else:
+            lines = (rest + data).split(b'\n')
+            rest = lines.pop()
+        out = []
+        for line in lines:
+            if not line.strip():
+                continue
+            if flt is None:
+                out.append(line)
+                continue
+            obj = flt.apply(line)
+            if obj is None:
+                continue
+            if flt.fields is not None:
+                out.append(json.dumps(obj).encode())
+            else:
+                out.append(line)
+        if out:
+            out.append(b'')
+            output_stream.write(b'\n'.join(out))
+        if not data:
+            break
+
+
+def add_filter_arguments(p):
+    '''
+    Add --where and --fields options, to be used by tools that read JSONL.
+    '''
+    p.add_argument('--where', '-w', action='append', metavar='FIELD=VALUE',
+        help='process only records with given field value; nested fields separated by dot; can be repeated')
+    p.add_argument('--fields', '-f', metavar='FIELD,...', help='output only given fields')
+
+
+def filter_from_args(args):
+    '''
+    Return JsonlFilter for parsed add_filter_arguments options, or None if no filtering was requested.
+    '''
+    if not args.where and not args.fields:
+        return None
+    conditions = []
+    for s in args.where or []:
+        if '=' not in s:
+            raise ValueError('Invalid --where condition (expected FIELD=VALUE): {!r}'.format(s))
+        field, value = s.split('=', 1)
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        conditions.append((parse_path(field), value))
+    fields = [parse_path(f) for f in args.fields.split(',')] if args.fields else None
+    return JsonlFilter(conditions, fields)
+
+
+def parse_path(s):
+    path = tuple(s.strip().split('.'))
+    if not all(path):
+        raise ValueError('Invalid field name: {!r}'.format(s))
+    return path
+
+
+class JsonlFilter:
+
+    def __init__(self, conditions, fields=None):
+        '''
+        conditions: list of (path, value), path is a tuple of field names
+        fields: list of paths for projection, or None
+        '''
+        self.conditions = conditions
+        self.fields = fields
+        self.needles = []
+        for path, value in conditions:
+            self.needles.extend(_needles(path, value))
+        self.needles_bytes = [n.encode() for n in self.needles]
+
+    def prefilter(self, line):
+        '''
+        Return False if the raw line (str or bytes) certainly doesn't match.
+        '''
+        needles = self.needles_bytes if isinstance(line, bytes) else self.needles
+        for needle in needles:
+            if needle not in line:
+                return False
+        return True
+
+    def match(self, obj):
+        for path, value in self.conditions:
+            found, v = get_path(obj, path)
+            if not found or not json_equal(v, value):
+                return False
+        return True
+
+    def project(self, obj):
+        if self.fields is None:
+            return obj
+        result = {}
+        for path in self.fields:
+            found, v = get_path(obj, path)
+            if not found:
+                continue
+            target = result
+            for name in path[:-1]:
+                target = target.setdefault(name, {})
+            target[path[-1]] = v
+        return result
+
+    def apply(self, line):
+        '''
+        Return projected record parsed from the line, or None if it doesn't match.
+        '''
+        if not self.prefilter(line):
+            return None
+        obj = loads(line)
+        if not self.match(obj):
+            return None
+        return self.project(obj)
+
+
+def _needles(path, value):
+    '''
+    Substrings that must be present in a raw JSON line that matches the condition.
+    '''
+    if _plain_string_re.match(path[-1]):
+        yield '"' + path[-1] + '"'
+    if isinstance(value, str) and _plain_string_re.match(value):
+        yield '"' + value + '"'
+    elif value is True:
+        yield 'true'
+    elif value is False:
+        yield 'false'
+    elif value is None:
+        yield 'null'
+
+
+def get_path(obj, path):
+    for name in path:
+        if not isinstance(obj, dict) or name not in obj:
+            return False, None
+        obj = obj[name]
+    return True, obj
+
+
+def json_equal(a, b):
+    if isinstance(a, bool) or isinstance(b, bool):
+        return a is b
+    return a == b
+
+
+if __name__ == '__main__':
+    main()
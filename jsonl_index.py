@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+'''
+Line offset index for random access to large JSONL (or any text) files.
+
+The index is built once by scanning the memory-mapped file and stored
+in a sidecar file FILE.idx as an array of 64-bit line start offsets.
+It is rebuilt automatically when the file size or mtime changes.
+
+    $ jsonl_index.py events.jsonl              # build index, print line count
+    $ jsonl_index.py events.jsonl --line 1000000
+    $ jsonl_index.py events.jsonl --tail 10
+    $ jsonl_index.py events.jsonl --sample 100
+
+Can be used also as a module by other tools:
+
+    with LineIndex('events.jsonl') as idx:
+        for line in idx.sample(100):
+            ...
+'''
+
+import argparse
+from array import array
+from itertools import accumulate, islice
+import logging
+import mmap
+import os
+import random
+import struct
+import sys
+
+
+logger = logging.getLogger(__name__)
+
+index_magic = b'JSONLIX1'
+index_header = struct.Struct('<8sQQQ') # magic, file size, file mtime_ns, line count
+scan_size = 16 * 1024 * 1024
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--verbose', '-v', action='store_true')
+    p.add_argument('--index-file', help='path to the index file (default: FILE.idx)')
+    p.add_argument('--line', '-n', type=int, help='print line N (numbered from 1)')
+    add_selection_arguments(p)
+    p.add_argument('file')
+    args = p.parse_args()
+    logging.basicConfig(
+        format='%(levelname)5s: %(message)s',
+        level=logging.DEBUG if args.verbose else logging.WARNING)
+    if args.line is not None and (args.head, args.tail, args.sample) != (None, None, None):
+        p.error('--line cannot be combined with --head, --tail or --sample')
+    if args.line is None and (args.head, args.tail, args.sample) == (None, None, None):
+        with LineIndex(args.file, index_path=args.index_file) as idx:
+            print(len(idx))
+        return
+    try:
+        for line in select_lines(args.file, index_path=args.index_file, line=args.line,
+                head=args.head, tail=args.tail, sample=args.sample, seed=args.seed):
+            sys.stdout.buffer.write(line)
+        sys.stdout.flush()
+    except IndexError as e:
+        sys.exit(str(e))
+    except BrokenPipeError as e:
+        os._exit(1)
+
+
+def add_selection_arguments(p):
+    '''
+    Add --head/--tail/--sample options, to be used by tools that read JSONL files.
+    '''
+    g = p.add_mutually_exclusive_group()
+    g.add_argument('--head', type=int, metavar='N', help='only first N lines (uses line index FILE.idx)')
+    g.add_argument('--tail', type=int, metavar='N', help='only last N lines (uses line index FILE.idx)')
+    g.add_argument('--sample', type=int, metavar='N', help='N uniformly sampled lines (uses line index FILE.idx)')
+    p.add_argument('--seed', type=int, help='random seed for --sample')
+
+
+def select_lines(path, index_path=None, line=None, head=None, tail=None, sample=None, seed=None):
+    '''
+    Yield selected lines of the file as bytes, always ending with newline.
+    '''
+    with LineIndex(path, index_path=index_path) as idx:
+        if line is not None:
+            if not 1 <= line <= len(idx):
+                raise IndexError('Line {} out of range 1..{}'.format(line, len(idx)))
+            lines = [idx[line - 1]]
+        elif head is not None:
+            lines = idx.head(head)
+        elif tail is not None:
+            lines = idx.tail(tail)
+        elif sample is not None:
+            lines = idx.sample(sample, random.Random(seed))
+        else:
+            lines = idx.lines()
+        for line in lines:
+            yield line if line.endswith(b'\n') else line + b'\n'
+
+
+class LineIndex:
+
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or path + '.idx'
+        self._file = open(path, 'rb')
+        st = os.fstat(self._file.fileno())
+        self.size = st.st_size
+        self._mtime_ns = st.st_mtime_ns
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+        self._index_mmap = None
+        self.offsets = self._load_index()
+        if self.offsets is None:
+            self.offsets = self._build_index()
+            self._save_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if isinstance(self.offsets, memoryview):
+            self.offsets.release()
+        if self._index_mmap is not None:
+            self._index_mmap.close()
+            self._index_mmap = None
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += len(self.offsets)
+        if not 0 <= n < len(self.offsets):
+            raise IndexError('line index out of range')
+        end = self.offsets[n + 1] if n + 1 < len(self.offsets) else self.size
+        return self._data[self.offsets[n]:end]
+
+    def lines(self, start=0, stop=None):
+        stop = len(self) if stop is None else min(stop, len(self))
+        for n in range(max(start, 0), stop):
+            yield self[n]
+
+    def head(self, count):
+        return self.lines(0, count)
+
+    def tail(self, count):
+        return self.lines(len(self) - count)
+
+    def sample(self, count, rng=random):
+        '''
+        Return uniformly sampled lines without repetition, in file order.
+        '''
+        return [self[n] for n in sorted(rng.sample(range(len(self)), min(count, len(self))))]
+
+    def _load_index(self):
+        try:
+            f = open(self.index_path, 'rb')
+        except FileNotFoundError:
+            return None
+        with f:
+            header = f.read(index_header.size)
+            if len(header) < index_header.size:
+                return None
+            magic, size, mtime_ns, count = index_header.unpack(header)
+            if magic != index_magic or size != self.size or mtime_ns != self._mtime_ns:
+                logger.debug('Index %s is stale', self.index_path)
+                return None
+            if count == 0:
+                return array('Q')
+            self._index_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offsets = memoryview(self._index_mmap)[index_header.size:].cast('Q')
+        if len(offsets) != count:
+            offsets.release()
+            self._index_mmap.close()
+            self._index_mmap = None
+            return None
+        logger.debug('Loaded index %s (%d lines)', self.index_path, count)
+        return offsets
+
+    def _build_index(self):
+        logger.debug('Building index of %s', self.path)
+        offsets = array('Q', [0] if self.size else [])
+        pos = 0
+        while pos < self.size:
+            chunk = self._data[pos:pos + scan_size]
+            parts = chunk.split(b'\n')
+            parts.pop() # the part after the last newline
+            # each newline starts a new line
+            offsets.extend(islice(accumulate((len(part) + 1 for part in parts), initial=pos), 1, None))
+            pos += len(chunk)
+        if offsets and offsets[-1] == self.size:
+            offsets.pop() # newline at the end of file
+        return offsets
+
+    def _save_index(self):
+        tmp_path = self.index_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(index_header.pack(index_magic, self.size, self._mtime_ns, len(self.offsets)))
+                self.offsets.tofile(f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logger.warning('Failed to save index %s: %s', self.index_path, e)
+
+
+if __name__ == '__main__':
+    main()
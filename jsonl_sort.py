@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+'''
+Sort JSONL file(s) by value of some field(s), for example:
+
+    $ jsonl_sort.py --key created_at events.jsonl > events-sorted.jsonl
+    $ jsonl_sort.py --key user.id,-created_at events.jsonl
+    $ jsonl_sort.py --key=-created_at events.jsonl
+
+Prefix - means descending order; if the first key is descending, use
+--key=-FIELD (argparse would take "--key -FIELD" for another option).
+
+Input larger than memory is sorted using external merge sort: sorted runs
+are written to temporary files and then merged. Lines are written unchanged.
+
+Values are ordered null < bool < number < string < anything else;
+missing fields are treated as null. Sort is stable.
+'''
+
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import heapq
+import json
+import logging
+import os
+import pickle
+import sys
+from tempfile import TemporaryDirectory
+from time import monotonic as monotime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+logger = logging.getLogger(__name__)
+
+loads = orjson.loads if orjson is not None else json.loads
+
+read_size = 1024 * 1024
+write_batch_size = 1024 * 1024
+pickle_batch_size = 1000
+max_merge_runs = 64
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--verbose', '-v', action='store_true')
+    p.add_argument('--key', '-k', required=True,
+        help='comma-separated field names, nested fields separated by dot, prefix - for descending order '
+             '(write --key=-FIELD when the first key is descending)')
+    p.add_argument('--buffer-size', '-S', default='64M', help='input size sorted in memory per run (default: %(default)s)')
+    p.add_argument('--jobs', '-j', type=int, default=1, help='generate sorted runs in N worker processes')
+    p.add_argument('--tmpdir', '-T', help='directory for temporary files')
+    p.add_argument('--output', '-o', help='output file (default: stdout)')
+    p.add_argument('input_file', nargs='*', help='JSONL files, - for stdin (default: stdin)')
+    args = p.parse_args()
+    logging.basicConfig(
+        format='%(levelname)5s: %(message)s',
+        level=logging.DEBUG if args.verbose else logging.WARNING)
+    try:
+        key_spec = parse_key_spec(args.key)
+        buffer_size = parse_size(args.buffer_size)
+    except ValueError as e:
+        p.error(str(e))
+    input_streams = [sys.stdin.buffer if f == '-' else open(f, 'rb') for f in args.input_file or ['-']]
+    output_stream = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        t0 = monotime()
+        line_count = external_sort(input_streams, output_stream, key_spec,
+            buffer_size=buffer_size, jobs=args.jobs, tmpdir=args.tmpdir)
+        output_stream.flush()
+        duration = monotime() - t0
+        logger.debug('Sorted %s lines in %.2f s (%.0f lines/s)', line_count, duration, line_count / max(duration, 1e-6))
+    except BrokenPipeError as e:
+        os._exit(1)
+
+
+def parse_size(s):
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30}
+    s = s.strip().upper()
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+
+def parse_key_spec(s):
+    '''
+    Parse 'a.b,-c' to [(('a', 'b'), False), (('c',), True)]; the bool means descending.
+    '''
+    spec = []
+    for part in s.split(','):
+        part = part.strip()
+        descending = part.startswith('-')
+        path = tuple(part.lstrip('-').split('.'))
+        if not all(path):
+            raise ValueError('Invalid sort key: {!r}'.format(s))
+        spec.append((path, descending))
+    return spec
+
+
+def external_sort(input_streams, output_stream, key_spec, buffer_size=64 * 2**20, jobs=1, tmpdir=None):
+    with TemporaryDirectory(prefix='jsonl_sort-', dir=tmpdir) as temp_dir:
+        runs = []
+        line_count = 0
+        chunks = enumerate(iter_chunks(input_streams, buffer_size))
+        if jobs > 1:
+            pending = deque()
+            with ProcessPoolExecutor(jobs) as executor:
+                for chunk_index, chunk in chunks:
+                    if len(pending) >= jobs:
+                        n, path = pending.popleft().result()
+                        runs.append(path)
+                        line_count += n
+                    run_path = os.path.join(temp_dir, 'run-{:06d}'.format(chunk_index))
+                    pending.append(executor.submit(sort_run, chunk, chunk_index, key_spec, run_path))
+                while pending:
+                    n, path = pending.popleft().result()
+                    runs.append(path)
+                    line_count += n
+        else:
+            for chunk_index, chunk in chunks:
+                run_path = os.path.join(temp_dir, 'run-{:06d}'.format(chunk_index))
+                n, path = sort_run(chunk, chunk_index, key_spec, run_path)
+                runs.append(path)
+                line_count += n
+        logger.debug('Generated %d sorted runs of %d lines', len(runs), line_count)
+
+        merge_pass = 0
+        while len(runs) > max_merge_runs:
+            # too many open files for a single merge - merge groups of runs to larger runs
+            merge_pass += 1
+            merged_runs = []
+            for i in range(0, len(runs), max_merge_runs):
+                path = os.path.join(temp_dir, 'merge-{}-{:06d}'.format(merge_pass, i))
+                with open(path, 'wb') as f:
+                    write_records(f, merge_runs(runs[i:i+max_merge_runs]))
+                merged_runs.append(path)
+            for path in runs:
+                os.unlink(path)
+            runs = merged_runs
+
+        out = []
+        out_size = 0
+        for key, chunk_index, line_index, line in merge_runs(runs):
+            out.append(line)
+            out_size += len(line)
+            if out_size >= write_batch_size:
+                output_stream.write(b''.join(out))
+                out = []
+                out_size = 0
+        output_stream.write(b''.join(out))
+    return line_count
+
+
+def iter_chunks(streams, size):
+    '''
+    Yield lists of lines (with line endings) of total size around given size.
+    '''
+    chunk = []
+    chunk_size = 0
+    for stream in streams:
+        rest = b''
+        while True:
+            data = stream.read(read_size)
+            if not data:
+                lines = [rest] if rest.strip() else []
+            else:
+                lines = (rest + data).split(b'\n')
+                rest = lines.pop()
+                lines = [line + b'\n' for line in lines if line.strip()]
+            chunk.extend(lines)
+            chunk_size += sum(len(line) for line in lines)
+            if chunk_size >= size:
+                yield chunk
+                chunk = []
+                chunk_size = 0
+            if not data:
+                break
+    if chunk:
+        yield chunk
+
+
+def sort_run(lines, chunk_index, key_spec, run_path):
+    '''
+    Sort lines in memory and write them to a run file; return (line count, run file path).
+    '''
+    records = []
+    for line_index, line in enumerate(lines):
+        if not line.endswith(b'\n'):
+            line += b'\n'
+        records.append((sort_key(loads(line), key_spec), chunk_index, line_index, line))
+    records.sort()
+    with open(run_path, 'wb') as f:
+        write_records(f, records)
+    return len(records), run_path
+
+
+def write_records(f, records):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= pickle_batch_size:
+            pickle.dump(batch, f, protocol=pickle.HIGHEST_PROTOCOL)
+            batch = []
+    if batch:
+        pickle.dump(batch, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def read_records(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                break
+            yield from batch
+
+
+def merge_runs(paths):
+    return heapq.merge(*[read_records(path) for path in paths])
+
+
+def sort_key(doc, key_spec):
+    key = []
+    for path, descending in key_spec:
+        value = doc
+        for name in path:
+            if isinstance(value, dict):
+                value = value.get(name)
+            else:
+                value = None
+                break
+        value = value_key(value)
+        key.append(Descending(value) if descending else value)
+    return tuple(key)
+
+
+def value_key(value):
+    if value is None:
+        return (0,)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    return (4, json.dumps(value, sort_keys=True))
+
+
+class Descending:
+    '''
+    Wrapper that reverses comparison of the wrapped value.
+    '''
+
+    __slots__ = ('value', )
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,262 @@
 #!/usr/bin/env python3
 
 import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+import hashlib
 import json
+from jsonl_filter import add_filter_arguments, filter_from_args
+from jsonl_index import add_selection_arguments, select_lines
+import logging
 import os
+import re
 import sys
+from time import monotonic as monotime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+logger = logging.getLogger(__name__)
+
+block_size = 4 * 1024 * 1024
+
+# shake_* digests need an explicit length, leave them out
+hash_algorithms = sorted(a for a in hashlib.algorithms_guaranteed if not a.startswith('shake_'))
+
+
+def stdlib_dump_sorted(obj):
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+# pick the fastest available JSON library; dump_sorted returns bytes without newline,
+# all backends produce the same compact UTF-8 form as orjson
+if orjson is not None:
+    json_backend = 'orjson'
+    def dump_sorted(obj):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+    loads = orjson.loads
+elif ujson is not None:
+    json_backend = 'ujson'
+    def dump_sorted(obj):
+        return ujson.dumps(obj, sort_keys=True, escape_forward_slashes=False, ensure_ascii=False).encode()
+    loads = ujson.loads
+else:
+    json_backend = 'json'
+    def dump_sorted(obj):
+        return stdlib_dump_sorted(obj)
+    loads = json.loads
 
 
 def main():
     p = argparse.ArgumentParser()
+    p.add_argument('--verbose', '-v', action='store_true')
+    p.add_argument('--jobs', '-j', type=int, default=1, help='process in N worker processes')
+    p.add_argument('--canonical', '-c', action='store_true', help='output canonical JSON (RFC 8785)')
+    p.add_argument('--hash', metavar='ALGORITHM', choices=hash_algorithms,
+        help='prepend hash of the canonical JSON and a tab to each line (implies --canonical)')
+    p.add_argument('--hash-only', action='store_true', help='output only the hash (use with --hash)')
+    add_selection_arguments(p)
+    add_filter_arguments(p)
+    p.add_argument('input_file', nargs='?', help='JSONL file (default: stdin)')
     args = p.parse_args()
-    for line in sys.stdin:
-        row = json.loads(line)
-        try:
-            print(json.dumps(row, sort_keys=True))
-        except BrokenPipeError as e:
-            os._exit(1)
+    if args.hash_only and not args.hash:
+        p.error('--hash-only requires --hash')
+    try:
+        flt = filter_from_args(args)
+    except ValueError as e:
+        p.error(str(e))
+    selection = dict(head=args.head, tail=args.tail, sample=args.sample, seed=args.seed)
+    if (args.head, args.tail, args.sample) != (None, None, None) and not args.input_file:
+        p.error('--head, --tail and --sample require input file')
+    logging.basicConfig(
+        format='%(levelname)5s: %(message)s',
+        level=logging.DEBUG if args.verbose else logging.WARNING)
+    logger.debug('JSON library: %s', json_backend)
+    try:
+        t0 = monotime()
+        if (args.head, args.tail, args.sample) != (None, None, None):
+            blocks = iter_line_blocks(select_lines(args.input_file, **selection))
+        elif args.input_file:
+            blocks = iter_blocks(open(args.input_file, 'rb'))
+        else:
+            blocks = iter_blocks(sys.stdin.buffer)
+        line_count = sort_keys_stream(blocks, sys.stdout.buffer, jobs=args.jobs,
+            canonical=args.canonical or bool(args.hash), hash_name=args.hash, hash_only=args.hash_only, flt=flt)
+        duration = monotime() - t0
+        logger.debug('Processed %s lines in %.2f s (%.0f lines/s)', line_count, duration, line_count / max(duration, 1e-6))
+    except BrokenPipeError as e:
+        os._exit(1)
+
+
+def sort_keys_stream(blocks, output_stream, jobs=1, canonical=False, hash_name=None, hash_only=False, flt=None):
+    options = dict(canonical=canonical, hash_name=hash_name, hash_only=hash_only, flt=flt)
+    line_count = 0
+    if jobs > 1:
+        pending = deque()
+        with ProcessPoolExecutor(jobs) as executor:
+            for block in blocks:
+                if len(pending) >= jobs * 2:
+                    n, out = pending.popleft().result()
+                    output_stream.write(out)
+                    line_count += n
+                pending.append(executor.submit(sort_keys_block, block, **options))
+            while pending:
+                n, out = pending.popleft().result()
+                output_stream.write(out)
+                line_count += n
+    else:
+        for block in blocks:
+            n, out = sort_keys_block(block, **options)
+            output_stream.write(out)
+            line_count += n
+    output_stream.flush()
+    return line_count
+
+
+def iter_blocks(stream):
+    '''
+    Read the stream in large blocks, yield blocks that end at a line boundary.
+    '''
+    rest = b''
+    while True:
+        data = stream.read(block_size)
+        if not data:
+            if rest:
+                yield rest
+            break
+        pos = data.rfind(b'\n')
+        if pos == -1:
+            rest += data
+            continue
+        yield rest + data[:pos+1]
+        rest = data[pos+1:]
+
+
+def iter_line_blocks(lines):
+    block = []
+    size = 0
+    for line in lines:
+        block.append(line)
+        size += len(line)
+        if size >= block_size:
+            yield b''.join(block)
+            block = []
+            size = 0
+    if block:
+        yield b''.join(block)
+
+
+# orjson silently parses integers that do not fit into 64 bits as floats
+_long_number_re = re.compile(rb'[0-9]{19}')
+
+
+def sort_keys_block(block, canonical=False, hash_name=None, hash_only=False, flt=None):
+    check_long_numbers = json_backend == 'orjson' and _long_number_re.search(block) is not None
+    out = []
+    for line in block.splitlines():
+        if not line.strip():
+            continue
+        if flt is not None and not flt.prefilter(line):
+            continue
+        if check_long_numbers and _long_number_re.search(line):
+            obj = json.loads(line)
+        else:
+            obj = parse_line(line)
+        if flt is not None:
+            if not flt.match(obj):
+                continue
+            obj = flt.project(obj)
+        if canonical:
+            data = canonical_dumps(obj).encode()
+        else:
+            data = dumps_sorted_safe(obj)
+        if hash_name:
+            h = hashlib.new(hash_name, data).hexdigest().encode()
+            data = h if hash_only else h + b'\t' + data
+        out.append(data)
+    out.append(b'')
+    return len(out) - 1, b'\n'.join(out)
+
+
+def parse_line(line):
+    try:
+        return loads(line)
+    except (ValueError, OverflowError):
+        if json_backend == 'json':
+            raise
+        # for example integers that do not fit into 64 bits
+        return json.loads(line)
+
+
+def dumps_sorted_safe(obj):
+    try:
+        return dump_sorted(obj)
+    except (TypeError, OverflowError):
+        if json_backend == 'json':
+            raise
+        return stdlib_dump_sorted(obj)
+
+
+def canonical_dumps(obj):
+    '''
+    Serialize to JSON according to RFC 8785 (JSON Canonicalization Scheme):
+    no whitespace, keys sorted by UTF-16 code units, minimal string escaping,
+    numbers formatted like ECMAScript Number.prototype.toString().
+    '''
+    if isinstance(obj, str):
+        return json.dumps(obj, ensure_ascii=False)
+    if obj is None:
+        return 'null'
+    if obj is True:
+        return 'true'
+    if obj is False:
+        return 'false'
+    if isinstance(obj, int):
+        if -2**53 < obj < 2**53:
+            return str(obj)
+        # all JSON numbers are IEEE 754 doubles in JCS
+        return canonical_number(float(obj))
+    if isinstance(obj, float):
+        return canonical_number(obj)
+    if isinstance(obj, dict):
+        items = sorted(obj.items(), key=lambda item: item[0].encode('utf-16-be'))
+        return '{' + ','.join(json.dumps(k, ensure_ascii=False) + ':' + canonical_dumps(v) for k, v in items) + '}'
+    if isinstance(obj, list):
+        return '[' + ','.join(canonical_dumps(v) for v in obj) + ']'
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+
+def canonical_number(x):
+    if x != x or x in (float('inf'), float('-inf')):
+        raise ValueError('NaN and Infinity are not allowed in canonical JSON')
+    if x == 0:
+        return '0'
+    sign = '-' if x < 0 else ''
+    # shortest round-trip digits, as in the ECMAScript algorithm
+    _, digit_tuple, exponent = Decimal(repr(abs(x))).as_tuple()
+    digits = ''.join(map(str, digit_tuple)).rstrip('0')
+    exponent += len(digit_tuple) - len(digits)
+    k = len(digits)
+    n = exponent + k
+    if k <= n <= 21:
+        s = digits + '0' * (n - k)
+    elif 0 < n <= 21:
+        s = digits[:n] + '.' + digits[n:]
+    elif -6 < n <= 0:
+        s = '0.' + '0' * -n + digits
+    else:
+        e = n - 1
+        s = digits[0] + ('.' + digits[1:] if k > 1 else '') + 'e' + ('+' if e >= 0 else '-') + str(abs(e))
+    return sign + s
 
 
 if __name__ == '__main__':
@@ -1,9 +1,25 @@
 #!/usr/bin/env python3
 
 import argparse
+from base64 import b64encode
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime
+import gzip
+import io
+from itertools import chain
+from jsonl_filter import add_filter_arguments, filter_from_args
+from jsonl_index import add_selection_arguments, select_lines
 import logging
-import yaml
+import lzma
+import os
+from queue import Queue
+import re
 import sys
+from threading import Thread
+import yaml
+import zlib
 
 try:
     import simplejson as json
@@ -13,35 +29,400 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# libyaml based dumper and loader are much faster than the pure Python ones
+YamlDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+batch_size = 1024 * 1024
+read_size = 1024 * 1024
+
 
 def main():
     p = argparse.ArgumentParser()
     p.add_argument('--indent', type=int, default=4)
+    p.add_argument('--reverse', '-r', action='store_true', help='convert YAML documents to JSONL')
+    p.add_argument('--jobs', '-j', type=int, default=1, help='with --reverse: parse YAML in N worker processes')
+    p.add_argument('--output', '-o', metavar='FILE', help='output file (default: stdout)')
+    p.add_argument('--compress', choices=['gzip', 'xz', 'zstd'],
+        help='compress output (default: by --output suffix .gz, .xz or .zst)')
+    add_selection_arguments(p)
+    add_filter_arguments(p)
+    p.add_argument('input_file', nargs='?',
+        help='JSONL file, or YAML file with --reverse; may be compressed with gzip, xz or zstd (default: stdin)')
     args = p.parse_args()
     logging.basicConfig(level=logging.DEBUG)
-    input_stream = sys.stdin
-    output_stream = sys.stdout
+    try:
+        flt = filter_from_args(args)
+    except ValueError as e:
+        p.error(str(e))
+    selection = (args.head, args.tail, args.sample) != (None, None, None)
+    if selection:
+        if args.reverse:
+            p.error('--head, --tail and --sample cannot be used with --reverse')
+        if not args.input_file:
+            p.error('--head, --tail and --sample require input file')
+        with open(args.input_file, 'rb') as f:
+            if detect_compression(f.read(6)):
+                p.error('--head, --tail and --sample require uncompressed input file')
+    compression = args.compress
+    if not compression and args.output:
+        compression = {'.gz': 'gzip', '.xz': 'xz', '.zst': 'zstd'}.get(os.path.splitext(args.output)[1])
+    if compression == 'zstd':
+        # check before the output file is truncated
+        try:
+            import zstandard
+        except ImportError:
+            sys.exit('Module zstandard is not installed, zstd compression is not available')
+    try:
+        with open_output(args.output, compression) as output_stream:
+            if args.reverse:
+                yaml_to_jsonl(open_input(args.input_file), output_stream, jobs=args.jobs, flt=flt)
+            elif selection:
+                input_chunks = (line.decode() for line in select_lines(
+                    args.input_file, head=args.head, tail=args.tail, sample=args.sample, seed=args.seed))
+                jsonl_to_yaml(input_chunks, output_stream, indent=args.indent, flt=flt)
+            else:
+                input_chunks = iter_chunks(open_input(args.input_file))
+                jsonl_to_yaml(input_chunks, output_stream, indent=args.indent, flt=flt)
+    except (EOFError, zlib.error, lzma.LZMAError) as e:
+        sys.exit('Failed to decompress input: {}'.format(e))
+    except BrokenPipeError as e:
+        os._exit(1)
+
+
+def jsonl_to_yaml(input_chunks, output_stream, indent, flt=None):
+    batch = []
+    batch_input_size = 0
+    for size, data in iter_documents(input_chunks, flt=flt):
+        if flt is not None:
+            if not flt.match(data):
+                continue
+            data = flt.project(data)
+        batch.append(data)
+        batch_input_size += size
+        if batch_input_size >= batch_size:
+            write_yaml_batch(output_stream, batch, indent=indent)
+            batch = []
+            batch_input_size = 0
+    write_yaml_batch(output_stream, batch, indent=indent)
+    output_stream.write('...\n')
+
+
+compression_magic = [
+    (b'\x1f\x8b', 'gzip'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+]
+
+
+def detect_compression(head):
+    for magic, compression in compression_magic:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def new_decompressor(compression):
+    if compression == 'gzip':
+        return zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    if compression == 'xz':
+        return lzma.LZMADecompressor()
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            sys.exit('Module zstandard is not installed, zstd compressed input is not supported')
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise Exception('Unknown compression: {!r}'.format(compression))
+
+
+def open_input(path):
+    '''
+    Open input file (or stdin) as text stream; compressed input is detected
+    by magic bytes and decompressed in a background thread.
+    '''
+    f = open(path, 'rb') if path and path != '-' else sys.stdin.buffer
+    head = f.read(6)
+    data_chunks = chain([head], iter(lambda: f.read(read_size), b''))
+    compression = detect_compression(head)
+    if compression:
+        logger.debug('Input is compressed with %s', compression)
+        data_chunks = iter_in_thread(decompress_chunks(data_chunks, compression))
+    return io.TextIOWrapper(io.BufferedReader(IterStream(data_chunks), read_size), encoding='utf-8')
+
+
+def decompress_chunks(data_chunks, compression):
+    decompressor = new_decompressor(compression)
+    started = False
+    for data in data_chunks:
+        while data:
+            yield decompressor.decompress(data)
+            started = True
+            data = b''
+            if decompressor.eof:
+                # concatenated streams (e.g. output of pigz or xz -T)
+                data = decompressor.unused_data
+                decompressor = new_decompressor(compression)
+                started = False
+    if started and not decompressor.eof:
+        raise EOFError('Compressed input ended before the end of {} stream (truncated file?)'.format(compression))
+
+
+def iter_in_thread(iterable, queue_size=8):
+    '''
+    Run the iterable in a background thread; decompression releases the GIL
+    so it runs in parallel with the parsing.
+    '''
+    q = Queue(queue_size)
+    done = object()
+
+    def run():
+        try:
+            for item in iterable:
+                q.put(item)
+        except BaseException as e:
+            q.put(_ThreadError(e))
+        q.put(done)
+
+    Thread(target=run, daemon=True).start()
     while True:
-        line = input_stream.readline()
-        if line == '':
+        item = q.get()
+        if item is done:
             break
-        line = line.strip()
-        if line.startswith('#'):
+        if isinstance(item, _ThreadError):
+            raise item.exception
+        yield item
+
+
+class _ThreadError:
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class IterStream(io.RawIOBase):
+    '''
+    Readable binary stream reading from iterable of bytes.
+    '''
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.rest = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.rest:
+            self.rest = next(self.chunks, None)
+            if self.rest is None:
+                self.rest = b''
+                return 0
+        n = min(len(b), len(self.rest))
+        b[:n] = self.rest[:n]
+        self.rest = self.rest[n:]
+        return n
+
+
+@contextmanager
+def open_output(path, compression=None):
+    '''
+    Open output file (or stdout) as text stream, optionally compressed.
+    '''
+    if not path or path == '-':
+        if not compression:
+            yield sys.stdout
+            sys.stdout.flush()
+            return
+        f = sys.stdout.buffer
+    else:
+        f = open(path, 'wb')
+    try:
+        if compression == 'gzip':
+            zf = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6)
+        elif compression == 'xz':
+            zf = lzma.LZMAFile(f, mode='wb')
+        elif compression == 'zstd':
+            import zstandard
+            zf = zstandard.ZstdCompressor().stream_writer(f, closefd=False)
+        else:
+            assert not compression
+            zf = None
+        out = io.TextIOWrapper(zf or f, encoding='utf-8')
+        yield out
+        out.flush()
+        out.detach()
+        if zf is not None:
+            zf.close()
+    finally:
+        if f is not sys.stdout.buffer:
+            f.close()
+
+
+def iter_chunks(stream):
+    while True:
+        chunk = stream.read(read_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+_ws_re = re.compile(r'[ \t\r\n]*')
+
+
+def iter_documents(chunks, flt=None):
+    '''
+    Parse JSON objects from a stream of text chunks.
+
+    Objects may be one per line, pretty-printed over multiple lines,
+    concatenated, or items of top-level arrays. Lines starting with #
+    are skipped. Yields (size of the source text, object).
+    '''
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buf = ''
+    pos = 0
+    eof = False
+    in_array = False
+    while True:
+        pos = _ws_re.match(buf, pos).end()
+        if pos == len(buf) or (buf[pos] == '#' and buf.find('\n', pos) == -1):
+            if eof:
+                break
+            # read more data, drop the processed part of the buffer
+            chunk = next(chunks, None)
+            if chunk is None:
+                eof = True
+            else:
+                buf = buf[pos:] + chunk
+                pos = 0
             continue
-        if not line.startswith('{'):
-            logger.warning("Line doesn't start with '{': %r", line)
+        c = buf[pos]
+        if c == '#':
+            pos = buf.find('\n', pos) + 1
             continue
-        if not line.endswith('}'):
-            logger.warning("Line doesn't end with '}': %r", line)
+        if in_array:
+            if c == ',':
+                pos += 1
+                continue
+            if c == ']':
+                in_array = False
+                pos += 1
+                continue
+        elif c == '[':
+            in_array = True
+            pos += 1
             continue
+        elif c == '{' and flt is not None and not in_array:
+            if not _prefilter_line(flt, buf, pos, eof):
+                pos = buf.find('\n', pos) + 1
+                continue
         try:
-            data = json.loads(line)
-        except Exception as e:
-            logger.exception('Failed to parse line: %r; line: %r', e, line)
-        yout = yaml.dump(data, indent=args.indent, default_flow_style=False, width=120)
-        output_stream.write('---\n')
-        output_stream.write(yout)
-    output_stream.write('...\n')
+            doc, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError as e:
+            if not eof and buf.find('\n', e.pos) == -1:
+                # the error is on the last line - probably just incomplete
+                chunk = next(chunks, None)
+                if chunk is None:
+                    eof = True
+                else:
+                    buf = buf[pos:] + chunk
+                    pos = 0
+                continue
+            line_end = buf.find('\n', e.pos)
+            line_end = len(buf) if line_end == -1 else line_end
+            logger.warning('Failed to parse JSON: %s; text: %r', e, buf[pos:line_end][:1000])
+            pos = line_end
+            in_array = False
+            continue
+        if isinstance(doc, dict):
+            yield end - pos, doc
+        else:
+            logger.warning('Not a JSON object: %r', buf[pos:end][:1000])
+        pos = end
+
+
+def _prefilter_line(flt, buf, pos, eof):
+    '''
+    Return False if the line starting at pos contains only whole JSON values
+    and certainly doesn't match the filter.
+    '''
+    line_end = buf.find('\n', pos)
+    if line_end == -1:
+        return True
+    line = buf[pos:line_end].rstrip()
+    if not line.endswith('}'):
+        return True
+    # if the next line starts a new value, the line cannot be a part of an unfinished object
+    next_pos = _ws_re.match(buf, line_end).end()
+    if next_pos == len(buf) and not eof:
+        return True
+    if next_pos < len(buf) and buf[next_pos] not in '{[#':
+        return True
+    return flt.prefilter(line)
+
+
+def write_yaml_batch(output_stream, docs, indent):
+    if docs:
+        output_stream.write(yaml.dump_all(docs, Dumper=YamlDumper, explicit_start=True,
+            indent=indent, default_flow_style=False, width=120))
+
+
+def yaml_to_jsonl(input_stream, output_stream, jobs=1, flt=None):
+    if jobs > 1:
+        pending = deque()
+        with ProcessPoolExecutor(jobs) as executor:
+            for batch in iter_yaml_batches(input_stream):
+                if len(pending) >= jobs * 2:
+                    output_stream.write(pending.popleft().result())
+                pending.append(executor.submit(yaml_batch_to_jsonl, batch, flt))
+            while pending:
+                output_stream.write(pending.popleft().result())
+    else:
+        for batch in iter_yaml_batches(input_stream):
+            output_stream.write(yaml_batch_to_jsonl(batch, flt))
+    output_stream.flush()
+
+
+def iter_yaml_batches(lines):
+    '''
+    Split YAML stream to parts of about batch_size characters, always at a document start.
+    '''
+    batch = []
+    size = 0
+    for line in lines:
+        if size >= batch_size and _document_start_re.match(line):
+            yield ''.join(batch)
+            batch = []
+            size = 0
+        batch.append(line)
+        size += len(line)
+    if batch:
+        yield ''.join(batch)
+
+
+_document_start_re = re.compile(r'---(\s|$)')
+
+
+def yaml_batch_to_jsonl(text, flt=None):
+    out = []
+    for doc in yaml.load_all(text, Loader=YamlLoader):
+        if doc is None:
+            continue
+        if flt is not None:
+            if not isinstance(doc, dict) or not flt.match(doc):
+                continue
+            doc = flt.project(doc)
+        out.append(json.dumps(doc, default=json_default) + '\n')
+    return ''.join(out)
+
+
+def json_default(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, bytes):
+        return b64encode(obj).decode('ascii')
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
 
 
 if __name__ == '__main__':
@@ -1,89 +1,722 @@
 #!/usr/bin/env python3
 
+'''
+Overview of all databases and collections on a MongoDB server:
+document counts, sizes, indexes, optionally document structure.
+
+    $ mongo_overview.py --structure mongodb://127.0.0.1:27017/
+
+To try it out locally, start mongod with instant_mongodb.py:
+
+    $ instant_mongodb.py --datadir /tmp/mongo-data &
+    $ mongo_overview.py mongodb://127.0.0.1:7017/
+'''
+
 import argparse
-from blessings import Terminal
-from datetime import datetime
-from collections import defaultdict
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, wait
 from contextlib import contextmanager
+import json
 import os
-import pymongo
+import re
 import sys
+from threading import Lock
+from time import monotonic as monotime
 from time import time
 from uuid import UUID
 import random
 
 
-assert pymongo.version.startswith('3.'), pymongo.version
+full_scan_batch_size = 10000
+
+latency_ranking_size = 20
+
+# index options that change what the index contains or how it is used
+index_options = ('unique', 'sparse', 'partialFilterExpression', 'expireAfterSeconds', 'collation', 'hidden')
+
+default_snapshot_dir = '~/.cache/mongo_overview'
 
-secondary_preferred = pymongo.ReadPreference.SECONDARY_PREFERRED
+_terminal = None
 
-t = Terminal()
+
+def terminal():
+    global _terminal
+    if _terminal is None:
+        # blessings and pymongo are imported only when needed, so that --help is fast
+        from blessings import Terminal
+        _terminal = Terminal()
+    return _terminal
 
 
 def main():
-    p = argparse.ArgumentParser()
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
     p.add_argument('mongo_uri', nargs='?', default='mongodb://127.0.0.1:27017/')
     p.add_argument('--structure', '-s', action='store_true', help='analyze document structure')
+    p.add_argument('--samples', type=int, default=100, help='number of sampled documents for --structure (default: %(default)s)')
+    p.add_argument('--full', action='store_true', help='analyze document structure of all documents (implies --structure)')
+    p.add_argument('--concurrency', '-c', type=int, default=8, help='number of parallel requests to the server (default: %(default)s)')
+    p.add_argument('--snapshot-dir', default=default_snapshot_dir,
+        help='directory where the result of each run is saved (default: %(default)s)')
+    p.add_argument('--no-snapshot', action='store_true', help='do not save snapshot of this run')
+    p.add_argument('--diff', action='store_true', help='show changes since the last snapshot')
+    p.add_argument('--cached', action='store_true', help='show the last snapshot instead of connecting to the server')
+    p.add_argument('--format', '-f', choices=('text', 'json', 'prometheus'), default='text',
+        help='output format; prometheus is for the node_exporter textfile collector (default: %(default)s)')
+    p.add_argument('--output', '-o', metavar='FILE', help='write json or prometheus output to file (replaced atomically) instead of stdout')
     args = p.parse_args()
-    pr = Printer(t=t)
+    if args.diff and args.format != 'text':
+        p.error('--diff is supported only with text output')
+    if args.output and args.format == 'text':
+        p.error('--output requires --format json or prometheus')
+    pr = Printer(t=terminal())
+    snapshot_dir = os.path.join(os.path.expanduser(args.snapshot_dir), snapshot_name(args.mongo_uri))
+    if args.cached:
+        snapshots = list_snapshots(snapshot_dir)
+        if not snapshots:
+            sys.exit('No snapshot found in {}'.format(snapshot_dir))
+        snapshot = load_snapshot(snapshots[-1])
+        previous = load_snapshot(snapshots[-2]) if args.diff and len(snapshots) > 1 else None
+        if args.format != 'text':
+            write_output(args.output, args.format, snapshot)
+            return
+        print('snapshot: {} from {}'.format(snapshots[-1], snapshot['time']))
+        render_overview(pr, snapshot_databases(snapshot), previous=previous, current_time=snapshot['time'])
+        return
+    previous = None
+    if args.diff:
+        snapshots = list_snapshots(snapshot_dir)
+        previous = load_snapshot(snapshots[-1]) if snapshots else None
+    try:
+        import pymongo
+    except ImportError:
+        sys.exit('Module pymongo is not installed, please run: pip install pymongo')
     client = pymongo.MongoClient(args.mongo_uri,
-        read_preference=secondary_preferred,
+        readPreference='secondaryPreferred',
         connectTimeoutMS=5000,
         serverSelectionTimeoutMS=5000)
-    print('client: {!r}; server version: {}'.format(client, client.server_info()['version']))
+    server_version = client.server_info()['version']
+    if args.format == 'text':
+        print('client: {!r}; server version: {}'.format(client, server_version))
     try:
-        overview(pr, client, structure=args.structure)
+        snapshot = new_snapshot()
+        databases = collect_overview(client, structure=args.structure or args.full, concurrency=args.concurrency,
+            sample_size=args.samples, full=args.full)
+        if args.format == 'text':
+            render_overview(pr, databases, snapshot=snapshot, previous=previous)
+        else:
+            for db_name, collections in databases:
+                snapshot['databases'][db_name] = dict(collections)
+            write_output(args.output, args.format, snapshot)
+        if not args.no_snapshot:
+            save_snapshot(snapshot_dir, snapshot)
     except KeyboardInterrupt as e:
-        sys.exit('(KeyboardInterrupt)')
+        # do not wait for running scans in executor threads (they are joined at interpreter exit)
+        sys.stdout.flush()
+        print('(KeyboardInterrupt)', file=sys.stderr, flush=True)
+        os._exit(1)
+    sys.stdout.flush()
     os._exit(0)
 
 
-def overview(pr, client, structure):
-    db_names = sorted(client.database_names())
-    for db_name in db_names:
+def collect_overview(client, structure, concurrency=8, sample_size=100, full=False):
+    '''
+    Yield (db_name, collections) in sorted order, collections is an iterator
+    of (c_name, record) where record is a dict returned by collection_record
+    or None for skipped system collections.
+
+    Collection stats are gathered in a thread pool (MongoClient is thread-safe)
+    and yielded as soon as they are available.
+
+    With full=True the collections are scanned in _id range partitions in a second
+    thread pool, so that at most `concurrency` scans run at the same time.
+    '''
+    executor = ThreadPoolExecutor(max(concurrency, 1))
+    scan = None
+    if full:
+        scan = FullScan(ThreadPoolExecutor(max(concurrency, 1)), partitions=max(concurrency, 1) * 4)
+    try:
+        db_names = sorted(client.list_database_names())
+        c_names_futures = [(db_name, executor.submit(list_collection_names, client[db_name])) for db_name in db_names]
+        db_infos = []
+        for db_name, c_names_future in c_names_futures:
+            db = client[db_name]
+            info_futures = []
+            for c_name in c_names_future.result():
+                if c_name == 'system.indexes' or (db_name == 'local' and c_name == 'startup_log'):
+                    info_futures.append((c_name, None))
+                else:
+                    info_futures.append((c_name, executor.submit(get_collection_info, db, c_name, structure, sample_size, scan)))
+            db_infos.append((db_name, info_futures))
+        for db_name, info_futures in db_infos:
+            yield db_name, _iter_collection_records(info_futures, scan)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        if scan is not None:
+            scan.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _iter_collection_records(info_futures, scan):
+    for c_name, info_future in info_futures:
+        if info_future is None:
+            yield c_name, None
+            continue
+        if scan is not None:
+            scan.wait_with_progress(info_future)
+        yield c_name, collection_record(info_future.result())
+
+
+def render_overview(pr, databases, snapshot=None, previous=None, current_time=None):
+    '''
+    Print the output of collect_overview (or snapshot_databases), optionally
+    together with changes since the previous snapshot. If snapshot is given,
+    the records are stored in it.
+    '''
+    prev_databases = previous['databases'] if previous else {}
+    days = None
+    if previous:
+        current_time = current_time or (snapshot['time'] if snapshot else datetime.now(timezone.utc).isoformat())
+        days = (parse_time(current_time) - parse_time(previous['time'])).total_seconds() / 86400
+    seen_db_names = set()
+    latency_ranking = []
+    for db_name, collections in databases:
+        seen_db_names.add(db_name)
+        db_records = snapshot['databases'].setdefault(db_name, {}) if snapshot is not None else {}
+        prev_db = prev_databases.get(db_name)
         pr.nl()
-        db = client[db_name]
         pr('db: {t.bold}{t.white}{name}{t.normal}', name=db_name)
         with pr.indent():
-            c_names = sorted(db.collection_names())
-            for c_name in c_names:
+            if previous and prev_db is None:
+                pr('{t.green}new database{t.normal}')
+            seen_c_names = set()
+            for c_name, record in collections:
+                seen_c_names.add(c_name)
+                db_records[c_name] = record
                 pr.nl()
-                c = db[c_name]
                 pr('collection: {t.yellow}{db_name}.{t.bold}{name:25}{t.normal}', name=c_name, db_name=db_name)
-                if c_name == 'system.indexes' or (db_name == 'local' and c_name == 'startup_log'):
+                if record is None:
                     continue
+                if record.get('latency'):
+                    latency_ranking.append((
+                        sum(stats['latency_us'] for stats in record['latency'].values()),
+                        sum(stats['ops'] for stats in record['latency'].values()),
+                        db_name + '.' + c_name))
                 with pr.indent():
-                    #pr('documents: {count}', count=c.count())
-
-                    stats = db.command({'collStats': c_name})
-                    pr('documents: {count} {t.black}avg size:{t.normal} {avgs} {t.black}total storage:{t.normal} {ts:.2f} MB',
-                        count=stats['count'],
-                        avgs=to_kbs(stats.get('avgObjSize')),
-                        ts=stats['storageSize']/2.**20)
-
-                    for index in sorted(c.list_indexes(), key=lambda index: index['name']):
-                        def format_key_item(item):
-                            name, order = item
-                            return '{}/{}'.format(name, order)
-                        desc = ', '.join(format_key_item(item) for item in index['key'].items())
-                        pr('index: {t.bold}{t.black}{name}{t.normal} ({key}) {size:.2f} kB',
-                            name=index['name'], key=desc, size=stats['indexSizes'][index['name']]/1024.)
-
-                    if structure:
-                        cursor = c.find()
-                        count = cursor.count()
-                        sample_indexes = random.sample(range(count), min(count, 100))
-                        t0 = time()
-                        samples = [cursor[i] for i in sample_indexes if time() - t0 < 5]
-                        sa = DocStructureAnalyzer()
-                        sa.analyze_docs(samples)
-                        pr('{t.blue}document structure{t.normal} {t.black}({n} samples){t.normal}:', n=len(samples))
-                        with pr.indent():
-                            sa.print_structure(prefix=pr.iprefix)
-
+                    if previous and (prev_db is None or c_name not in prev_db):
+                        pr('{t.green}new collection{t.normal}')
+                    print_collection_info(pr, record)
+                    if previous and prev_db and prev_db.get(c_name):
+                        print_collection_diff(pr, record, prev_db[c_name], days)
+            for c_name in sorted(set(prev_db or ()) - seen_c_names):
+                pr.nl()
+                pr('collection: {t.yellow}{db_name}.{t.bold}{name:25}{t.normal} {t.red}removed{t.normal}', name=c_name, db_name=db_name)
+    for db_name in sorted(set(prev_databases) - seen_db_names):
+        pr.nl()
+        pr('db: {t.bold}{t.white}{name}{t.normal} {t.red}removed{t.normal}', name=db_name)
+    latency_ranking = sorted((x for x in latency_ranking if x[0]), reverse=True)[:latency_ranking_size]
+    if latency_ranking:
+        pr.nl()
+        pr('{t.bold}collections by total operation latency:{t.normal}')
+        with pr.indent():
+            for latency_us, ops, full_name in latency_ranking:
+                pr('{t.yellow}{name:40}{t.normal} {ms:12.1f} ms {ops:12} ops', name=full_name, ms=latency_us / 1e3, ops=ops)
     pr.nl()
 
 
+def print_collection_diff(pr, record, prev, days):
+    count_delta = record['count'] - prev['count']
+    storage_delta = (record['storage_size'] - prev['storage_size']) / 2.**20
+    pr('{t.blue}change:{t.normal} {count:+d} documents ({rate}/day), storage {storage:+.2f} MB ({srate}/day)',
+        count=count_delta,
+        rate='{:+.0f}'.format(count_delta / days) if days else '-',
+        storage=storage_delta,
+        srate='{:+.2f} MB'.format(storage_delta / days) if days else '-')
+    index_names = {index['name'] for index in record['indexes']}
+    prev_index_names = {index['name'] for index in prev['indexes']}
+    for name in sorted(index_names - prev_index_names):
+        pr('{t.green}new index:{t.normal} {name}', name=name)
+    for name in sorted(prev_index_names - index_names):
+        pr('{t.red}removed index:{t.normal} {name}', name=name)
+    if record.get('structure') and prev.get('structure'):
+        paths = set(iter_field_paths(record['structure']))
+        prev_paths = set(iter_field_paths(prev['structure']))
+        for path in sorted(paths - prev_paths):
+            pr('{t.green}new field:{t.normal} {path}', path=path)
+        for path in sorted(prev_paths - paths):
+            pr('{t.red}removed field:{t.normal} {path}', path=path)
+
+
+def iter_field_paths(node, prefix=''):
+    '''
+    Yield dotted paths of all fields in serialized _DSANode; array items are marked as [].
+    '''
+    for key, field in node['fields'].items():
+        path = prefix + key
+        yield path
+        for child_key in 'dict', 'list':
+            if child_key in field:
+                yield from iter_field_paths(field[child_key], path + '.')
+
+
+def write_output(path, output_format, snapshot):
+    if path is None:
+        write_formatted(sys.stdout, output_format, snapshot)
+        sys.stdout.flush()
+        return
+    # write to temporary file first so that readers (like node_exporter) never see partial file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        write_formatted(f, output_format, snapshot)
+    os.replace(tmp_path, path)
+
+
+def write_formatted(f, output_format, snapshot):
+    if output_format == 'json':
+        json.dump(snapshot, f, indent=2, sort_keys=True)
+        f.write('\n')
+    elif output_format == 'prometheus':
+        f.writelines(format_prometheus(snapshot))
+    else:
+        raise ValueError('Unknown output format: {!r}'.format(output_format))
+
+
+prometheus_collection_metrics = [
+    # metric name, record key, help
+    ('mongodb_collection_documents', 'count', 'Number of documents in the collection'),
+    ('mongodb_collection_size_bytes', 'size', 'Uncompressed size of documents in the collection'),
+    ('mongodb_collection_avg_object_size_bytes', 'avg_obj_size', 'Average document size'),
+    ('mongodb_collection_storage_size_bytes', 'storage_size', 'Storage size of the collection'),
+]
+
+
+prometheus_latency_metrics = [
+    ('mongodb_collection_operations_total', 'ops', 'Number of operations (from $collStats latencyStats)'),
+    ('mongodb_collection_operation_latency_microseconds_total', 'latency_us', 'Total operation latency (from $collStats latencyStats)'),
+]
+
+
+def format_prometheus(snapshot):
+    '''
+    Yield lines in Prometheus text exposition format.
+    '''
+    collections = [
+        (db_name, c_name, record)
+        for db_name, records in sorted(snapshot['databases'].items())
+        for c_name, record in sorted(records.items())
+        if record is not None]
+    for metric, key, help_text in prometheus_collection_metrics:
+        yield '# HELP {} {}\n'.format(metric, help_text)
+        yield '# TYPE {} gauge\n'.format(metric)
+        for db_name, c_name, record in collections:
+            if record.get(key) is not None:
+                yield '{}{{database="{}",collection="{}"}} {}\n'.format(
+                    metric, prometheus_escape(db_name), prometheus_escape(c_name), record[key])
+    yield '# HELP mongodb_index_size_bytes Size of the index\n'
+    yield '# TYPE mongodb_index_size_bytes gauge\n'
+    for db_name, c_name, record in collections:
+        for index in record['indexes']:
+            if index['size'] is not None:
+                yield 'mongodb_index_size_bytes{{database="{}",collection="{}",index="{}"}} {}\n'.format(
+                    prometheus_escape(db_name), prometheus_escape(c_name), prometheus_escape(index['name']), index['size'])
+    yield '# HELP mongodb_index_accesses_total Number of operations that used the index (from $indexStats)\n'
+    yield '# TYPE mongodb_index_accesses_total counter\n'
+    for db_name, c_name, record in collections:
+        for index in record['indexes']:
+            if index.get('accesses') is not None:
+                yield 'mongodb_index_accesses_total{{database="{}",collection="{}",index="{}"}} {}\n'.format(
+                    prometheus_escape(db_name), prometheus_escape(c_name), prometheus_escape(index['name']), index['accesses'])
+    for metric, key, help_text in prometheus_latency_metrics:
+        yield '# HELP {} {}\n'.format(metric, help_text)
+        yield '# TYPE {} counter\n'.format(metric)
+        for db_name, c_name, record in collections:
+            for op_type, stats in sorted((record.get('latency') or {}).items()):
+                yield '{}{{database="{}",collection="{}",op_type="{}"}} {}\n'.format(
+                    metric, prometheus_escape(db_name), prometheus_escape(c_name), prometheus_escape(op_type), stats[key])
+    yield '# HELP mongodb_overview_timestamp_seconds Time when the stats were collected\n'
+    yield '# TYPE mongodb_overview_timestamp_seconds gauge\n'
+    yield 'mongodb_overview_timestamp_seconds {:.3f}\n'.format(parse_time(snapshot['time']).timestamp())
+
+
+def prometheus_escape(s):
+    return s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def snapshot_name(mongo_uri):
+    '''
+    Snapshot directory name for the server(s) from the URI, without credentials.
+    '''
+    hosts = mongo_uri.split('://', 1)[-1].split('/', 1)[0].split('?', 1)[0]
+    hosts = hosts.rsplit('@', 1)[-1]
+    return re.sub(r'[^A-Za-z0-9.,_-]', '_', hosts) or 'default'
+
+
+def new_snapshot():
+    return {'version': 1, 'time': datetime.now(timezone.utc).isoformat(), 'databases': {}}
+
+
+def list_snapshots(snapshot_dir):
+    try:
+        names = os.listdir(snapshot_dir)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(snapshot_dir, name) for name in sorted(names) if name.endswith('.json')]
+
+
+def load_snapshot(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_snapshot(snapshot_dir, snapshot):
+    os.makedirs(snapshot_dir, exist_ok=True)
+    path = os.path.join(snapshot_dir, parse_time(snapshot['time']).strftime('%Y%m%dT%H%M%SZ') + '.json')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)
+
+
+def snapshot_databases(snapshot):
+    '''
+    Return snapshot contents in the same form as collect_overview.
+    '''
+    for db_name, records in sorted(snapshot['databases'].items()):
+        yield db_name, iter(sorted(records.items()))
+
+
+def parse_time(s):
+    return datetime.fromisoformat(s)
+
+
+def list_collection_names(db):
+    return sorted(db.list_collection_names())
+
+
+def get_collection_info(db, c_name, structure, sample_size=100, scan=None):
+    from pymongo.errors import OperationFailure
+    c = db[c_name]
+    info = {}
+    try:
+        info['stats'] = db.command({'collStats': c_name})
+        info['indexes'] = sorted(c.list_indexes(), key=lambda index: index['name'])
+    except OperationFailure as e:
+        # for example views have no storage stats nor indexes
+        print('collStats failed on {}: {}'.format(c.full_name, e), file=sys.stderr)
+        info['stats'] = {'count': c.estimated_document_count(), 'storageSize': 0, 'indexSizes': {}}
+        info['indexes'] = []
+    info['index_stats'] = get_index_stats(c)
+    info['latency_stats'] = get_latency_stats(c)
+    if structure and scan is not None:
+        t0 = monotime()
+        info['structure'] = scan.analyze(c)
+        info['structure_duration'] = monotime() - t0
+    elif structure:
+        info['structure'] = DocStructureAnalyzer()
+        info['structure'].analyze_docs(sample_documents(c, sample_size))
+    return info
+
+
+def get_index_stats(c):
+    '''
+    Return {index name: (accesses, since)} from $indexStats, or None if not available.
+    Usage is counted per server, so the primary is asked if possible.
+    '''
+    from pymongo import ReadPreference
+    from pymongo.errors import OperationFailure
+    c = c.with_options(read_preference=ReadPreference.PRIMARY_PREFERRED)
+    try:
+        docs = list(c.aggregate([{'$indexStats': {}}]))
+    except OperationFailure as e:
+        return None
+    result = {}
+    for doc in docs:
+        # sharded collections return one document per shard
+        ops, since = result.get(doc['name'], (0, None))
+        accesses = doc.get('accesses') or {}
+        ops += accesses.get('ops', 0)
+        if accesses.get('since') and (since is None or accesses['since'] < since):
+            since = accesses['since']
+        result[doc['name']] = (ops, since)
+    return result
+
+
+def get_latency_stats(c):
+    '''
+    Return {'reads'|'writes'|'commands'|...: {'ops': n, 'latency_us': n, 'histogram': [[micros, count], ...]}}
+    from $collStats latencyStats, or None if not available.
+    '''
+    from pymongo import ReadPreference
+    from pymongo.errors import OperationFailure
+    c = c.with_options(read_preference=ReadPreference.PRIMARY_PREFERRED)
+    try:
+        docs = list(c.aggregate([{'$collStats': {'latencyStats': {'histograms': True}}}]))
+    except OperationFailure as e:
+        return None
+    result = {}
+    for doc in docs:
+        for op_type, stats in sorted((doc.get('latencyStats') or {}).items()):
+            if not isinstance(stats, dict):
+                continue
+            r = result.setdefault(op_type, {'ops': 0, 'latency_us': 0, 'histogram': {}})
+            r['ops'] += stats.get('ops', 0)
+            r['latency_us'] += stats.get('latency', 0)
+            for bucket in stats.get('histogram', []):
+                r['histogram'][bucket['micros']] = r['histogram'].get(bucket['micros'], 0) + bucket['count']
+    for r in result.values():
+        r['histogram'] = [[int(micros), int(count)] for micros, count in sorted(r['histogram'].items())]
+        r['ops'], r['latency_us'] = int(r['ops']), int(r['latency_us'])
+    return result
+
+
+def collection_record(info):
+    '''
+    Convert result of get_collection_info to JSON-serializable dict
+    that is rendered and saved in snapshots.
+    '''
+    stats = info['stats']
+    record = {
+        'count': stats['count'],
+        'size': stats.get('size'),
+        'avg_obj_size': stats.get('avgObjSize'),
+        'storage_size': stats['storageSize'],
+        'indexes': [
+            {
+                'name': index['name'],
+                'key': [[name, order] for name, order in index['key'].items()],
+                'size': stats['indexSizes'].get(index['name']),
+                'options': sorted(k for k in index_options if k in index),
+            } for index in info['indexes']],
+    }
+    if info.get('index_stats') is not None:
+        for index in record['indexes']:
+            if index['name'] in info['index_stats']:
+                ops, since = info['index_stats'][index['name']]
+                index['accesses'] = int(ops)
+                index['accesses_since'] = since.isoformat() if since else None
+    if info.get('latency_stats') is not None:
+        record['latency'] = info['latency_stats']
+    if 'structure' in info:
+        record['structure'] = info['structure'].root.to_dict()
+        if 'structure_duration' in info:
+            record['structure']['duration'] = info['structure_duration']
+    return record
+
+
+class FullScan:
+    '''
+    Analyze structure of all documents of a collection. The collection is split
+    to _id ranges that are scanned in parallel, each by its own analyzer;
+    the partial summaries are merged at the end.
+    '''
+
+    def __init__(self, executor, partitions):
+        self.executor = executor
+        self.partitions = partitions
+        self.lock = Lock()
+        self.doc_count = 0
+        self.t0 = monotime()
+
+    def analyze(self, c):
+        futures = [self.executor.submit(self.scan_partition, c, query) for query in id_range_queries(c, self.partitions)]
+        sa = DocStructureAnalyzer()
+        for f in futures:
+            sa.merge(f.result())
+        return sa
+
+    def scan_partition(self, c, query):
+        sa = DocStructureAnalyzer()
+        cursor = c.find(query, batch_size=full_scan_batch_size)
+        if query:
+            cursor = cursor.hint([('_id', 1)])
+        n = 0
+        for doc in cursor:
+            sa.analyze_doc(doc)
+            n += 1
+            if n == 1000:
+                self.add_progress(n)
+                n = 0
+        self.add_progress(n)
+        return sa
+
+    def add_progress(self, n):
+        with self.lock:
+            self.doc_count += n
+
+    def wait_with_progress(self, future):
+        '''
+        Wait for the future, meanwhile show progress line on stderr if it is a terminal.
+        '''
+        show = sys.stderr.isatty()
+        shown = False
+        while not wait([future], timeout=1).done:
+            if show:
+                duration = monotime() - self.t0
+                sys.stderr.write('\rscanned {} documents ({:.0f} docs/s)\x1b[K'.format(
+                    self.doc_count, self.doc_count / max(duration, 1e-6)))
+                sys.stderr.flush()
+                shown = True
+        if shown:
+            sys.stderr.write('\r\x1b[K')
+            sys.stderr.flush()
+
+
+def sample_documents(c, size, timeout=5):
+    '''
+    Return randomly selected documents using server-side $sample;
+    fall back to _id range sampling if $sample is not available.
+    '''
+    from pymongo.errors import OperationFailure
+    try:
+        return list(c.aggregate([{'$sample': {'size': size}}], maxTimeMS=timeout * 1000))
+    except OperationFailure as e:
+        print('$sample failed on {}: {}'.format(c.full_name, e), file=sys.stderr)
+    return sample_documents_by_id(c, size, timeout=timeout)
+
+
+def sample_documents_by_id(c, size, timeout=5):
+    '''
+    Pick random points between the lowest and highest _id (ObjectId or number)
+    and fetch the first document at or after each of them; every lookup
+    is a single _id index seek. Other _id types get just the first documents.
+    '''
+    space = get_id_space(c)
+    if space is None:
+        return list(c.find().limit(size))
+    lo, hi, to_id = space
+    samples = {}
+    t0 = time()
+    for i in range(size * 2):
+        if len(samples) >= size or time() - t0 > timeout:
+            break
+        doc = c.find_one({'_id': {'$gte': to_id(random.randint(lo, hi))}}, sort=[('_id', 1)])
+        if doc is not None:
+            samples.setdefault(repr(doc['_id']), doc)
+    return list(samples.values())
+
+
+def id_range_queries(c, count):
+    '''
+    Return queries that split the collection to (at most) count _id ranges.
+    '''
+    space = get_id_space(c)
+    if space is None:
+        return [{}]
+    lo, hi, to_id = space
+    bounds = sorted(set(lo + (hi - lo) * i // count for i in range(1, count)) - {lo})
+    queries = []
+    start = None
+    for bound in bounds + [None]:
+        q = {}
+        if start is not None:
+            q['$gte'] = to_id(start)
+        if bound is not None:
+            q['$lt'] = to_id(bound)
+        queries.append({'_id': q} if q else {})
+        start = bound
+    return queries
+
+
+def get_id_space(c):
+    '''
+    If all _id values are ObjectIds or numbers, return (lo, hi, to_id) where
+    lo and hi are ints and to_id converts int from lo..hi to _id value.
+    Return None for other _id types or empty collection.
+    '''
+    from bson import ObjectId
+    first = c.find_one(sort=[('_id', 1)], projection={'_id': 1})
+    last = c.find_one(sort=[('_id', -1)], projection={'_id': 1})
+    if first is None:
+        return None
+    lo, hi = first['_id'], last['_id']
+    if isinstance(lo, ObjectId) and isinstance(hi, ObjectId):
+        return int(str(lo), 16), int(str(hi), 16), lambda n: ObjectId('{:024x}'.format(n))
+    if all(isinstance(x, int) and not isinstance(x, bool) for x in (lo, hi)):
+        return lo, hi, lambda n: n
+    if all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in (lo, hi)):
+        return 0, 2**32, lambda n: lo + (hi - lo) * n / 2**32
+    return None
+
+
+def print_collection_info(pr, record):
+    pr('documents: {count} {t.black}avg size:{t.normal} {avgs} {t.black}total storage:{t.normal} {ts:.2f} MB',
+        count=record['count'],
+        avgs=to_kbs(record['avg_obj_size']),
+        ts=record['storage_size']/2.**20)
+
+    redundant = find_redundant_indexes(record['indexes'])
+    for index in record['indexes']:
+        desc = ', '.join('{}/{}'.format(name, order) for name, order in index['key'])
+        line = 'index: {t.bold}{t.black}{name}{t.normal} ({key}) {size:.2f} kB'
+        if 'accesses' in index:
+            line += ' {t.black}{accesses} accesses{t.normal}'
+            if index['accesses'] == 0 and index['name'] != '_id_':
+                line += ' {t.red}unused{t.normal}'
+                if index.get('accesses_since'):
+                    line += ' {t.black}since {since}{t.normal}'
+        if index['name'] in redundant:
+            line += ' {t.red}redundant{t.normal} {t.black}(prefix of {covering}){t.normal}'
+        pr(line, name=index['name'], key=desc, size=(index['size'] or 0)/1024.,
+            accesses=index.get('accesses'), since=index.get('accesses_since'),
+            covering=redundant.get(index['name']))
+
+    if record.get('latency'):
+        for op_type, stats in sorted(record['latency'].items()):
+            if not stats['ops']:
+                continue
+            pr('{t.blue}{op_type}:{t.normal} {ops} ops, avg {avg:.2f} ms, p50 {p50} ms, p99 {p99} ms',
+                op_type=op_type, ops=stats['ops'], avg=stats['latency_us'] / stats['ops'] / 1000,
+                p50=histogram_percentile(stats['histogram'], 50),
+                p99=histogram_percentile(stats['histogram'], 99))
+
+    if record.get('structure'):
+        sa = DocStructureAnalyzer.from_dict(record['structure'])
+        if 'duration' in record['structure']:
+            pr('{t.blue}document structure{t.normal} {t.black}({n} documents, full scan, {rate:.0f} docs/s){t.normal}:',
+                n=sa.root.count, rate=sa.root.count / max(record['structure']['duration'], 1e-6))
+        else:
+            pr('{t.blue}document structure{t.normal} {t.black}({n} samples){t.normal}:', n=sa.root.count)
+        with pr.indent():
+            sa.print_structure(prefix=pr.iprefix)
+
+
+def find_redundant_indexes(indexes):
+    '''
+    Return {index name: name of other index} for indexes whose key is a prefix
+    of another index key, so the other index can serve the same queries.
+    Indexes with options (unique, partial, TTL...) are never reported.
+    '''
+    result = {}
+    for index in indexes:
+        if index['name'] == '_id_' or index.get('options'):
+            continue
+        key = [tuple(item) for item in index['key']]
+        if not all(isinstance(order, (int, float)) for name, order in key):
+            continue
+        for other in indexes:
+            if other is index or set(other.get('options', ())) & {'sparse', 'partialFilterExpression', 'collation', 'hidden'}:
+                continue
+            other_key = [tuple(item) for item in other['key']]
+            if len(other_key) > len(key) and other_key[:len(key)] == key:
+                result[index['name']] = other['name']
+                break
+    return result
+
+
+def histogram_percentile(histogram, pct):
+    '''
+    Approximate percentile (in ms) from latencyStats histogram [[lower bound micros, count], ...];
+    returns lower bound of the bucket where the percentile falls.
+    '''
+    total = sum(count for micros, count in histogram)
+    if not total:
+        return '-'
+    n = 0
+    for micros, count in histogram:
+        n += count
+        if n >= total * pct / 100:
+            return '{:g}'.format(micros / 1000)
+    return '-'
+
+
 class DocStructureAnalyzer:
 
     def __init__(self):
@@ -94,90 +727,239 @@ class DocStructureAnalyzer:
             self.analyze_doc(doc)
 
     def analyze_doc(self, doc):
+        if not _bson_types_added:
+            _add_bson_type_names()
         self.root.process(doc)
 
+    def merge(self, other):
+        '''
+        Add summary from another DocStructureAnalyzer (for example from a parallel worker).
+        '''
+        self.root.merge(other.root)
+
     def print_structure(self, prefix=''):
         self.root.print_(prefix)
 
+    @classmethod
+    def from_dict(cls, data):
+        '''
+        Load summary serialized by _DSANode.to_dict (for example from a snapshot).
+        '''
+        sa = cls()
+        sa.root = _DSANode.from_dict(data)
+        return sa
+
+
+# BSON value types as decoded by pymongo; subclasses (Int64 of int, Code of str,
+# Binary of bytes, SON of dict...) are matched first, see _type_name
+_bson_type_names = {
+    type(None): 'null',
+    str: 'str',
+    bytes: 'bytes',
+    dict: 'dict',
+    list: 'list',
+    int: 'int',
+    float: 'float',
+    datetime: 'datetime',
+    UUID: 'UUID',
+    re.Pattern: 'Regex',
+}
+
+
+_bson_types_added = False
+
+
+def _add_bson_type_names():
+    '''
+    Called before analyzing documents, not on import, so that --help and --cached
+    work without pymongo (bson) being imported.
+    '''
+    global _bson_types_added
+    from bson import Binary, Code, DBRef, Decimal128, Int64, MaxKey, MinKey, ObjectId, Regex, Timestamp
+    _bson_type_names.update({
+        ObjectId: 'ObjectId',
+        Int64: 'Int64',
+        Decimal128: 'Decimal128',
+        Binary: 'Binary',
+        Code: 'Code',
+        Regex: 'Regex',
+        Timestamp: 'Timestamp',
+        DBRef: 'DBRef',
+        MinKey: 'MinKey',
+        MaxKey: 'MaxKey',
+    })
+    _bson_types_added = True
+
+_no_sample_types = {'null', 'true', 'false', 'dict', 'list', 'MinKey', 'MaxKey'}
+
+
+def _type_name(v):
+    if v is True:
+        return 'true'
+    if v is False:
+        return 'false'
+    try:
+        return _bson_type_names[type(v)]
+    except KeyError:
+        pass
+    for cls in type(v).__mro__[1:]:
+        if cls in _bson_type_names:
+            name = _bson_type_names[cls]
+            break
+    else:
+        name = type(v).__name__
+    _bson_type_names[type(v)] = name
+    return name
+
 
 class _DSANode:
     '''
-    Helper class for DocStructureAnalyzer
+    Helper class for DocStructureAnalyzer - summary of documents at one nesting level
     '''
 
+    __slots__ = ('count', 'fields')
+
     def __init__(self):
-        self.items = defaultdict(lambda: defaultdict(dict))
         self.count = 0
+        self.fields = {}
 
     def process(self, d):
-        from bson import ObjectId
-        from datetime import datetime
-        assert isinstance(d, dict)
         self.count += 1
+        fields = self.fields
         for k, v in d.items():
-            assert isinstance(k, str)
-            desc = self.items[k]
-            if v is None:
-                desc['null']['count'] = desc['null'].get('count', 0) + 1
-            elif v is True:
-                desc['true']['count'] = desc['true'].get('count', 0) + 1
-            elif v is False:
-                desc['false']['count'] = desc['false'].get('count', 0) + 1
-            elif isinstance(v, str):
-                desc['str']['count'] = desc['str'].get('count', 0) + 1
-                desc['str']['sample_content'] = v
-            elif isinstance(v, bytes):
-                desc['bytes']['count'] = desc['bytes'].get('count', 0) + 1
-                desc['bytes']['sample_content'] = v
-            elif isinstance(v, dict):
-                desc['dict']['count'] = desc['dict'].get('count', 0) + 1
-                if not desc['dict'].get('node'):
-                    desc['dict']['node'] = _DSANode()
-                desc['dict']['node'].process(v)
-            elif isinstance(v, list):
-                desc['list']['count'] = desc['list'].get('count', 0) + 1
-                if not desc['list'].get('node'):
-                    desc['list']['node'] = _DSANode()
+            field = fields.get(k)
+            if field is None:
+                field = fields[k] = _DSAField()
+            type_name = _type_name(v)
+            counts = field.counts
+            counts[type_name] = counts.get(type_name, 0) + 1
+            if type_name == 'dict':
+                if field.dict_node is None:
+                    field.dict_node = _DSANode()
+                field.dict_node.process(v)
+            elif type_name == 'list':
+                if field.list_node is None:
+                    field.list_node = _DSANode()
                 for vi in v:
-                    desc['list']['node'].process({'[]': vi})
-            elif isinstance(v, int):
-                desc['int']['count'] = desc['int'].get('count', 0) + 1
-                desc['int']['sample_content'] = v
-            elif isinstance(v, float):
-                desc['float']['count'] = desc['float'].get('count', 0) + 1
-                desc['float']['sample_content'] = v
-            elif isinstance(v, datetime):
-                desc['datetime']['count'] = desc['datetime'].get('count', 0) + 1
-                desc['datetime']['sample_content'] = v
-            elif isinstance(v, ObjectId):
-                desc['ObjectId']['count'] = desc['ObjectId'].get('count', 0) + 1
-                desc['ObjectId']['sample_content'] = v
-            elif isinstance(v, UUID):
-                desc['UUID']['count'] = desc['UUID'].get('count', 0) + 1
-                desc['UUID']['sample_content'] = v
-            else:
-                raise Exception('Unknown type {}'.format(type(v)))
+                    field.list_node.process({'[]': vi})
+            elif type_name not in _no_sample_types:
+                field.samples[type_name] = v
+
+    def merge(self, other):
+        self.count += other.count
+        for k, other_field in other.fields.items():
+            field = self.fields.get(k)
+            if field is None:
+                field = self.fields[k] = _DSAField()
+            field.merge(other_field)
 
     def print_(self, prefix):
-        for key, x in sorted(self.items.items()):
-            for type_name, metadata in x.items():
+        t = terminal()
+        for key, field in sorted(self.fields.items()):
+            if len(field.counts) > 1:
+                line = prefix + '{t.green}{k}{t.normal}: {t.black}({pct} % present){t.normal}'.format(
+                    k=key, t=t, pct=format_pct(100*sum(field.counts.values())/self.count))
+                print(line)
+            for type_name, count in field.counts.items():
                 line = prefix
                 line += '{t.green}{k}{t.normal}: {t.black}{t.bold}{tn}{t.normal}'.format(k=key, tn=type_name, t=t)
-                line += ' {t.black}({pct:.0f} %){t.normal}'.format(t=t, pct=100*metadata['count']/self.count)
-                if 'sample_content' in metadata:
-                    sc = metadata['sample_content']
-                    if isinstance(sc, datetime):
-                        sc = str(sc)
-                    else:
-                        sc = repr(sc)
-                    if len(sc) > 100:
-                        sc = sc[:80] + '…'
-                    line += ' {sc}'.format(sc=sc)
+                line += ' {t.black}({pct} %){t.normal}'.format(t=t, pct=format_pct(100*count/self.count))
+                if type_name in field.samples:
+                    line += ' {sc}'.format(sc=format_sample(field.samples[type_name]))
                 print(line)
                 if type_name == 'dict':
-                    metadata['node'].print_(prefix + '    ')
+                    field.dict_node.print_(prefix + '    ')
                 if type_name == 'list':
-                    metadata['node'].print_(prefix + '    ')
+                    field.list_node.print_(prefix + '    ')
+
+
+    def to_dict(self):
+        return {'count': self.count, 'fields': {k: field.to_dict() for k, field in self.fields.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        node = cls()
+        node.count = data['count']
+        node.fields = {k: _DSAField.from_dict(field_data) for k, field_data in data['fields'].items()}
+        return node
+
+
+class _DSAField:
+    '''
+    Helper class for DocStructureAnalyzer - summary of values of one key
+    '''
+
+    __slots__ = ('counts', 'samples', 'dict_node', 'list_node')
+
+    def __init__(self):
+        self.counts = {} # type name -> number of values
+        self.samples = {} # type name -> sample value
+        self.dict_node = None
+        self.list_node = None
+
+    def merge(self, other):
+        for type_name, count in other.counts.items():
+            self.counts[type_name] = self.counts.get(type_name, 0) + count
+        for type_name, sample in other.samples.items():
+            self.samples.setdefault(type_name, sample)
+        if other.dict_node is not None:
+            if self.dict_node is None:
+                self.dict_node = _DSANode()
+            self.dict_node.merge(other.dict_node)
+        if other.list_node is not None:
+            if self.list_node is None:
+                self.list_node = _DSANode()
+            self.list_node.merge(other.list_node)
+
+    def to_dict(self):
+        data = {'counts': dict(self.counts)}
+        if self.samples:
+            data['samples'] = {type_name: format_sample(v) for type_name, v in self.samples.items()}
+        if self.dict_node is not None:
+            data['dict'] = self.dict_node.to_dict()
+        if self.list_node is not None:
+            data['list'] = self.list_node.to_dict()
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        field = cls()
+        field.counts = dict(data['counts'])
+        field.samples = {type_name: _FormattedSample(v) for type_name, v in data.get('samples', {}).items()}
+        if 'dict' in data:
+            field.dict_node = _DSANode.from_dict(data['dict'])
+        if 'list' in data:
+            field.list_node = _DSANode.from_dict(data['list'])
+        return field
+
+
+class _FormattedSample(str):
+    '''
+    Sample value that was already formatted by format_sample (loaded from snapshot)
+    '''
+
+
+def format_sample(v):
+    if isinstance(v, _FormattedSample):
+        return v
+    if isinstance(v, datetime):
+        s = str(v)
+    else:
+        s = repr(v)
+    if len(s) > 100:
+        s = s[:80] + '…'
+    return s
+
+
+def format_pct(pct):
+    '''
+    Show rare values (as found by full scan) as non-zero percentage.
+    '''
+    if 0 < pct < 1:
+        return '{:.2g}'.format(pct)
+    if 99 < pct < 100:
+        return '{:.6g}'.format(pct)
+    return '{:.0f}'.format(pct)
 
 
 def to_kbs(n):
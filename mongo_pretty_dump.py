@@ -7,11 +7,12 @@
 import argparse
 from base64 import b64encode
 from blessings import Terminal
-from bson import ObjectId
+from bson import ObjectId, json_util
 from contextlib import contextmanager
 from datetime import datetime
 import os
 import pymongo
+import sys
 from uuid import UUID
 import zlib
 import lzma
@@ -30,7 +31,18 @@ def main():
     p = argparse.ArgumentParser()
     p.add_argument('mongo_uri', nargs='?', default='mongodb://127.0.0.1:27017/')
     p.add_argument('collection', nargs='?')
+    p.add_argument('--limit', '-n', type=int, default=10, help='number of documents per collection (default: %(default)s)')
+    p.add_argument('--skip', type=int, default=0, help='skip N most recent documents')
+    p.add_argument('--query', '-q', help='filter documents by query in MongoDB extended JSON')
     args = p.parse_args()
+    if args.limit < 1 or args.skip < 0:
+        p.error('--limit must be positive and --skip must not be negative')
+    query = {}
+    if args.query:
+        try:
+            query = json_util.loads(args.query)
+        except ValueError as e:
+            p.error('Invalid --query: {}'.format(e))
     pr = Printer(t=t)
     mongo_uri = args.mongo_uri
     if not mongo_uri.startswith('mongodb://'):
@@ -41,7 +53,7 @@ def main():
         serverSelectionTimeoutMS=3000)
     arg_db_name = pymongo.uri_parser.parse_uri(mongo_uri)['database']
     try:
-        for db_name in sorted(client.database_names()):
+        for db_name in sorted(client.list_database_names()):
             if arg_db_name and db_name != arg_db_name:
                 continue
             if not arg_db_name and db_name == 'local':
@@ -50,25 +62,43 @@ def main():
             pr('db: {}', t.white_bold(db_name))
             with pr.indent():
                 db = client[db_name]
-                for collection_name in sorted(db.collection_names()):
-                    if args.collection and collection_names != args.collection:
+                for collection_name in sorted(db.list_collection_names()):
+                    if args.collection and collection_name != args.collection:
                         continue
                     pr.nl()
                     pr('collection: {}.{}', t.yellow(db_name), t.yellow_bold(collection_name))
                     c = db[collection_name]
                     with pr.indent():
-                        doc_count = c.count()
-                        start_index = max(0, doc_count - 10)
-                        for n, doc in enumerate(c.find()[start_index:], start=1):
-                            pr.nl()
-                            pr('document {}/{}:', start_index + n, doc_count)
-                            with pr.indent():
-                                print_document(pr, doc)
+                        print_last_documents(pr, c, query=query, limit=args.limit, skip=args.skip)
     finally:
         print(t.normal)
     os._exit(0) # do not wait for mongo cleanup etc.
 
 
+def print_last_documents(pr, c, query, limit, skip=0):
+    '''
+    Print the last documents (by _id) in ascending order, without the linear
+    server-side skip of find()[count - limit:].
+    '''
+    # first get just the _ids of the last documents, newest first - walks the _id index from the end
+    ids = [doc['_id'] for doc in c.find(query, {'_id': 1}).sort('_id', -1).skip(skip).limit(limit)]
+    if not ids:
+        return
+    # total count is known only without query; estimated_document_count uses collection metadata
+    doc_count = None if query else c.estimated_document_count()
+    start_index = max(0, doc_count - skip - len(ids)) if doc_count is not None else 0
+    cursor = c.find({'_id': {'$in': ids}}).sort('_id', 1).batch_size(min(len(ids), 100))
+    for n, doc in enumerate(cursor, start=1):
+        pr.nl()
+        if doc_count is None:
+            pr('document {}/{}:', n, len(ids))
+        else:
+            pr('document {}/{}:', start_index + n, doc_count)
+        with pr.indent():
+            print_document(pr, doc)
+        sys.stdout.flush()
+
+
 def print_document(pr, doc):
     assert isinstance(doc, dict)
     for k, v in sorted(doc.items()):